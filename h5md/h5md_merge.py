@@ -19,64 +19,340 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import argparse
 import h5py
+import itertools
 import numpy as np
-import shutil
+import os
 
-parser = argparse.ArgumentParser(
-    'Stack input file on top of output file (only groups in /particles)')
-parser.add_argument('input_file', help='Input H5MD file')
-parser.add_argument('output_file', help='Output (appendable) H5MD file')
-parser.add_argument('group_name', help='Particles group')
-parser.add_argument('--backup_output', action='store_false', default=True)
-parser.add_argument('--renumber_steps', action='store_true',
-                    help='Renumber /step dataset (with the same spacing!')
-parser.add_argument('--renumber_time', action='store_true',
-                    help='Renumber /time dataset (with the same spacing!')
+# Datasets of H5MD time-dependent element.
+ELEMENT_DATASETS = ('value', 'step', 'time')
 
-args = parser.parse_args()
 
-# Merge only particles
-if args.backup_output:
-    print('Making backup {file}->{file}.bak'.format(file=args.output_file))
-    shutil.copy(args.output_file, '{}.bak'.format(args.output_file))
+def _args():
+    parser = argparse.ArgumentParser(
+        'Merge H5MD files of restarted simulation (time series in /particles and /observables)')
+    parser.add_argument('input_files', nargs='+', help='Input H5MD files in order of the simulation')
+    parser.add_argument('--output', required=True, help='Output H5MD file')
+    parser.add_argument('--append', action='store_true', default=False,
+                        help='Append inputs to the existing output file instead of creating it')
+    parser.add_argument('--group', action='append', default=None,
+                        help='Particles group to merge (can be repeated), default: all')
+    parser.add_argument('--allow_gaps', action='store_true', default=False,
+                        help='Only warn about missing frames between files')
+    parser.add_argument('--drop_overlapped', action='store_true', default=False,
+                        help='Allow to drop files that are fully replaced by the following files')
+    parser.add_argument('--no_direct_chunk', action='store_true', default=False,
+                        help='Always decompress and compress chunks')
+    parser.add_argument('--block_mb', type=int, default=256, help='Memory used for a copied block in MB')
+    parser.add_argument('--renumber_steps', action='store_true',
+                        help=('Renumber /step dataset (with the same spacing!), files with step '
+                              'restarted from the beginning are concatenated'))
+    parser.add_argument('--renumber_time', action='store_true',
+                        help=('Renumber /time dataset (with the same spacing!), files with time '
+                              'restarted from the beginning are concatenated'))
+    return parser.parse_args()
 
-input_file = h5py.File(args.input_file, 'r')
-output_file = h5py.File(args.output_file, 'r+')
-group_name = args.group_name
 
-old_particles = output_file['/particles/{}/'.format(group_name)]
-new_particles = input_file['/particles/{}/'.format(group_name)]
+def find_elements(h5, groups=None):
+    """Returns paths of time-dependent elements (value with step or time) in /particles and /observables."""
+    elements = []
 
+    def visit(name, obj):
+        if not isinstance(obj, h5py.Group) or not isinstance(obj.get('value'), h5py.Dataset):
+            return
+        value = obj['value']
+        if value.ndim > 0 and any(isinstance(obj.get(k), h5py.Dataset) and obj[k].shape == value.shape[:1]
+                                  for k in ('step', 'time')):
+            elements.append(name)
 
-def merge_datasets(path):
-    input_dataset = new_particles[path]
-    output_dataset = old_particles[path]
-    old_shape = output_dataset.shape
-    output_dataset.resize(output_dataset.shape[0] + input_dataset.shape[0], 0)
-    output_dataset[old_shape[0]:] = input_dataset
-    return output_dataset
+    roots = []
+    if 'particles' in h5:
+        roots.extend('particles/{}'.format(g) for g in (groups or h5['particles']))
+    if 'observables' in h5:
+        roots.append('observables')
+    for root in roots:
+        h5[root].visititems(lambda name, obj: visit('{}/{}'.format(root, name), obj))
+    return elements
+
+
+def element_datasets(element):
+    """Returns names of datasets of the element that follow the time axis."""
+    length = element['value'].shape[0]
+    return [k for k in ELEMENT_DATASETS
+            if isinstance(element.get(k), h5py.Dataset) and element[k].shape[:1] == (length,)]
+
+
+def frame_keys(element):
+    """Returns the name of the key dataset (step or time) and the key of every frame."""
+    name = 'step' if 'step' in element_datasets(element) else 'time'
+    return name, np.array(element[name])
+
+
+def plan_ranges(keys):
+    """Returns kept (begin, end) frames of every segment.
+
+    Frames of the segment at or after the first frame of any following segment
+    are removed, the restarted run replaces them.
+    """
+    ranges = []
+    limit = None
+    for key in reversed(keys):
+        stop = len(key) if limit is None else int(np.searchsorted(key, limit, side='left'))
+        ranges.append((0, stop))
+        if len(key) > 0:
+            limit = key[0] if limit is None else min(limit, key[0])
+    return ranges[::-1]
+
+
+def _spacing(keys):
+    diffs = [np.diff(k) for k in keys if len(k) > 1]
+    return np.median(np.concatenate(diffs)) if diffs else 1
+
+
+def continue_keys(keys):
+    """Returns keys of segments shifted to follow the previous segment.
+
+    Used for files where step (or time) starts again from the beginning, all
+    their frames are kept.
+    """
+    spacing = _spacing(keys)
+    shifted = []
+    last = None
+    for key in keys:
+        if len(key) > 0 and last is not None:
+            key = key - key[0] + last + spacing
+        if len(key) > 0:
+            last = key[-1]
+        shifted.append(key)
+    return shifted
+
+
+def check_continuity(element_name, keys, ranges, file_names, allow_gaps):
+    """Checks that the kept frames follow each other without gaps."""
+    if not any(b - a > 1 for a, b in ranges):
+        return
+    spacing = _spacing([k[a:b] for k, (a, b) in zip(keys, ranges)])
+    last = None
+    for key, (a, b), file_name in zip(keys, ranges, file_names):
+        if b - a == 0:
+            if len(key) > 0:
+                print('Warning!: {} in {} is dropped, it is replaced by the following files'.format(
+                    element_name, file_name))
+            continue
+        if np.any(np.diff(key[a:b]) <= 0):
+            raise RuntimeError('{} in {} is not ordered in time'.format(element_name, file_name))
+        if last is not None:
+            gap = key[a] - last
+            if not np.isclose(gap, spacing):
+                msg = '{}: {} starts at {} but the previous frame is {} (spacing {})'.format(
+                    element_name, file_name, key[a], last, spacing)
+                if allow_gaps:
+                    print('Warning!: ' + msg)
+                else:
+                    raise RuntimeError(msg + ', use --allow_gaps to merge anyway')
+        last = key[b-1]
+
+
+def _filters(ds):
+    dcpl = ds.id.get_create_plist()
+    return [dcpl.get_filter(i)[:3] for i in range(dcpl.get_nfilters())]
+
+
+def can_copy_chunks(in_ds, out_ds):
+    """Checks if chunks can be copied without decompression."""
+    return (in_ds.chunks is not None and in_ds.chunks == out_ds.chunks and in_ds.dtype == out_ds.dtype and
+            _filters(in_ds) == _filters(out_ds) and hasattr(in_ds.id, 'read_direct_chunk'))
+
+
+def copy_frames(in_ds, out_ds, begin, end, offset, direct, block_bytes):
+    """Copies frames begin:end of in_ds to out_ds from offset.
+
+    Whole chunks with the same position in the chunk grid of both datasets are copied
+    directly, the rest is copied in blocks of at most block_bytes.
+    """
+    plain = [(begin, end)]
+    if direct and end > begin:
+        chunk_t = in_ds.chunks[0]
+        first = -(-begin // chunk_t) * chunk_t
+        last = min(end, in_ds.shape[0]) // chunk_t * chunk_t
+        if (offset - begin) % chunk_t == 0 and first < last:
+            plain = [(begin, first), (last, end)]
+            other_axes = [range(0, s, c) for s, c in zip(in_ds.shape[1:], in_ds.chunks[1:])]
+            for t in range(first, last, chunk_t):
+                for corner in itertools.product(*other_axes):
+                    try:
+                        filter_mask, data = in_ds.id.read_direct_chunk((t, ) + corner)
+                    except (KeyError, RuntimeError, ValueError):
+                        # Chunk not allocated in the input.
+                        plain.append((t, t + chunk_t))
+                        break
+                    out_ds.id.write_direct_chunk((t - begin + offset, ) + corner, data, filter_mask)
+    frame_bytes = max(1, int(np.prod(in_ds.shape[1:])) * in_ds.dtype.itemsize)
+    block = max(1, block_bytes // frame_bytes)
+    if in_ds.chunks:
+        block = max(in_ds.chunks[0], block // in_ds.chunks[0] * in_ds.chunks[0])
+    for b0, b1 in plain:
+        for s in range(b0, b1, block):
+            e = min(b1, s + block)
+            out_ds[s - begin + offset:e - begin + offset] = in_ds[s:e]
+
+
+def _create_like(out_h5, name, ds, length):
+    """Creates extendable dataset with the properties of ds and length frames."""
+    out_ds = out_h5.create_dataset(
+        name, shape=(length, ) + ds.shape[1:], dtype=ds.dtype, chunks=ds.chunks or True,
+        maxshape=(None, ) + ds.shape[1:], compression=ds.compression, compression_opts=ds.compression_opts,
+        shuffle=ds.shuffle, fletcher32=ds.fletcher32, scaleoffset=ds.scaleoffset)
+    out_ds.attrs.update(ds.attrs)
+    return out_ds
+
+
+def copy_structure(in_h5, out_h5, skip):
+    """Copies everything except datasets in skip.
+
+    Links are walked instead of objects (visititems visits an object only once),
+    an object linked under several paths is copied once and hard-linked to the others.
+    """
+    first_path = {}
+
+    def walk(group, prefix):
+        for key in group:
+            name = prefix + key
+            link = group.get(key, getlink=True)
+            if isinstance(link, (h5py.SoftLink, h5py.ExternalLink)):
+                out_h5[name] = link
+                continue
+            obj = group[key]
+            if name in skip:
+                continue
+            if obj.id in first_path:
+                out_h5[name] = out_h5[first_path[obj.id]]
+                continue
+            first_path[obj.id] = name
+            if isinstance(obj, h5py.Group):
+                out_h5.require_group(name).attrs.update(obj.attrs)
+                walk(obj, name + '/')
+            else:
+                parent, _, base = name.rpartition('/')
+                in_h5.copy(obj, out_h5[parent or '/'], name=base)
+
+    walk(in_h5, '')
+    out_h5.attrs.update(in_h5.attrs)
 
 
 def renumber_dataset(ds):
-    if len(ds.shape) > 1:
+    if len(ds.shape) > 1 or ds.shape[0] < 4:
         return
     spacing = ds[3] - ds[2]
     ds_length = ds.shape[0]
     start_element = ds[0]
-    ds[:] = np.arange(start_element, start_element+ds_length*spacing, spacing, dtype=ds.dtype)
-    assert np.all(np.diff(ds) == spacing)
+    ds[:] = start_element + np.arange(ds_length, dtype=ds.dtype)*spacing
+    assert np.allclose(np.diff(ds), spacing)
 
 
-def merge_group(name, object):
-    if isinstance(object, h5py._hl.group.Group):
-        return
-    print('Merging dataset {}'.format(object.name))
-    result_dataset = merge_datasets(object.name)
-    if args.renumber_steps and name.endswith('step'):
-        print('Renumbering {}'.format(object.name))
-        renumber_dataset(result_dataset)
-    if args.renumber_time and name.endswith('time'):
-        print('Renumbering {}'.format(object.name))
-        renumber_dataset(result_dataset)
-
-old_particles.visititems(merge_group)
+def plan_element(element_name, segments, file_names, args):
+    """Checks the element in all segments and returns kept (begin, end) frames of every segment."""
+    for h5, file_name in zip(segments, file_names):
+        if element_name not in h5:
+            raise RuntimeError('{} not found in {}'.format(element_name, file_name))
+    for ds_name in element_datasets(segments[0][element_name]):
+        path = '{}/{}'.format(element_name, ds_name)
+        for h5, file_name in zip(segments[1:], file_names[1:]):
+            if h5[path].shape[1:] != segments[0][path].shape[1:] or h5[path].dtype != segments[0][path].dtype:
+                raise RuntimeError('{} in {} has different shape or dtype'.format(path, file_name))
+
+    keyed = [frame_keys(h5[element_name]) for h5 in segments]
+    key_name = keyed[0][0]
+    keys = [k for _, k in keyed]
+    ranges = plan_ranges(keys)
+    # A file without any kept frame starts at or after a following file: the key does not
+    # increase across files (restart from the beginning), these are not dropped silently.
+    replaced = [f for f, k, (a, b) in zip(file_names, keys, ranges) if len(k) > 0 and b == a]
+    if replaced:
+        renumber = args.renumber_steps if key_name == 'step' else args.renumber_time
+        if renumber:
+            print('{}: {} restarts in {}, files are concatenated and renumbered'.format(
+                element_name, key_name, ', '.join(replaced)))
+            keys = continue_keys(keys)
+            ranges = plan_ranges(keys)
+        elif not args.drop_overlapped:
+            raise RuntimeError(
+                '{}: {} does not increase across files, {} would be fully replaced by the following '
+                'files. Use --renumber_{} to concatenate files with restarted {}, or --drop_overlapped '
+                'to drop them'.format(element_name, key_name, ', '.join(replaced),
+                                      'steps' if key_name == 'step' else 'time', key_name))
+    check_continuity(element_name, keys, ranges, file_names, args.allow_gaps)
+    return ranges
+
+
+def merge(inputs, out_h5, args):
+    """Merges time-dependent elements of inputs into out_h5.
+
+    In append mode the existing output is the first segment. All elements are
+    checked before anything is written. Every output dataset is resized (or
+    created) once and filled segment by segment.
+    """
+    segments = ([out_h5] if args.append else []) + inputs
+    file_names = [h5.filename for h5 in segments]
+    elements = find_elements(segments[0], args.group)
+    plans = [(e, plan_element(e, segments, file_names, args)) for e in elements]
+    if not args.append:
+        copy_structure(inputs[0], out_h5, set('{}/{}'.format(e, d) for e in elements
+                                              for d in element_datasets(inputs[0][e])))
+
+    # Element datasets shared by hard links (e.g. time of position and id) are written once.
+    written = {}
+    for element_name, ranges in plans:
+        total = sum(b - a for a, b in ranges)
+        dropped = sum(h5[element_name]['value'].shape[0] for h5 in segments) - total
+        print('Merging {}: {} frames{}'.format(
+            element_name, total, ', {} overlapping frames removed'.format(dropped) if dropped else ''))
+
+        for ds_name in element_datasets(segments[0][element_name]):
+            path = '{}/{}'.format(element_name, ds_name)
+            source = (out_h5 if args.append else inputs[0])[path].id
+            if source in written and written[source][1] == ranges:
+                if not args.append:
+                    out_h5[path] = out_h5[written[source][0]]
+                print('  {} (linked to {})'.format(path, written[source][0]))
+                continue
+            written[source] = (path, ranges)
+            if args.append:
+                out_ds = out_h5[path]
+                out_ds.resize(total, axis=0)
+                offset, sources = ranges[0][1], list(zip(segments[1:], ranges[1:]))
+            else:
+                out_ds = _create_like(out_h5, path, inputs[0][path], total)
+                offset, sources = 0, list(zip(segments, ranges))
+            num_direct = 0
+            for h5, (a, b) in sources:
+                in_ds = h5[path]
+                direct = not args.no_direct_chunk and can_copy_chunks(in_ds, out_ds)
+                copy_frames(in_ds, out_ds, a, b, offset, direct, args.block_mb * 1024**2)
+                offset += b - a
+                num_direct += direct
+            print('  {} ({}/{} files with direct chunk copy)'.format(path, num_direct, len(sources)))
+            if (args.renumber_steps and ds_name == 'step') or (args.renumber_time and ds_name == 'time'):
+                print('Renumbering {}'.format(path))
+                renumber_dataset(out_ds)
+
+
+def main():
+    args = _args()
+    inputs = [h5py.File(f, 'r') for f in args.input_files]
+    output_file = h5py.File(args.output, 'r+' if args.append else 'w-')
+    try:
+        merge(inputs, output_file, args)
+    except Exception:
+        output_file.close()
+        # The new output is not left half-written.
+        if not args.append:
+            os.remove(args.output)
+        raise
+    output_file.close()
+    for h5 in inputs:
+        h5.close()
+    print('Saved in {}'.format(args.output))
+
+
+if __name__ == '__main__':
+    main()
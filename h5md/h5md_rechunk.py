@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+"""
+Copyright (C) 2017 Jakub Krajniak <jkrajniak@gmail.com>
+
+This file is distributed under free software licence:
+you can redistribute it and/or modify it under the terms of the
+GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import argparse
+import h5py
+import itertools
+import numpy
+import sys
+import time
+
+# Groups with the data, everything else is copied as is.
+DATA_GROUPS = ('particles', 'observables', 'connectivity')
+
+
+def _args():
+    parser = argparse.ArgumentParser('Copy H5MD file with chunk layout tuned for analysis')
+    parser.add_argument('in_file')
+    parser.add_argument('out_file')
+    parser.add_argument('--layout', choices=('frame', 'particle', 'balanced'), default='frame',
+                        help=('frame: chunks of whole frames (block reading, RDF); '
+                              'particle: chunks of few particles over many frames (MSD, ACF); '
+                              'balanced: square-like chunks in frames and particles'))
+    parser.add_argument('--chunk_kb', type=int, default=1024, help='Target size of the chunk in kB')
+    parser.add_argument('--compression', choices=('none', 'gzip', 'lzf', 'blosc'), default='none',
+                        help='Filter of the output datasets, blosc requires hdf5plugin')
+    parser.add_argument('--compression_level', type=int, default=4, help='Level of gzip/blosc compression')
+    parser.add_argument('--shuffle', action='store_true', default=False, help='Use byte shuffle filter')
+    parser.add_argument('--block_mb', type=int, default=256, help='Memory used for a copied block in MB')
+    parser.add_argument('--no_benchmark', action='store_true', default=False,
+                        help='Do not measure the read throughput before and after')
+    return parser.parse_args()
+
+
+def chunk_shape(shape, itemsize, layout, chunk_bytes):
+    """Returns the chunk shape of the dataset for the layout.
+
+    Time series (T, N, ...) get chunks of whole frames (frame), of the whole
+    time range of few particles (particle) or the same number of frames
+    and particles (balanced). Other datasets are chunked along the first axis.
+    """
+    if len(shape) == 0 or 0 in shape:
+        return None
+    row_bytes = int(numpy.prod(shape[1:])) * itemsize
+    if len(shape) == 1 or layout == 'frame':
+        return (int(max(1, min(shape[0], chunk_bytes // row_bytes))),) + tuple(shape[1:])
+    rest = tuple(shape[2:])
+    item_bytes = int(numpy.prod(rest)) * itemsize
+    if layout == 'particle':
+        t = min(shape[0], max(1, chunk_bytes // item_bytes))
+        n = min(shape[1], max(1, chunk_bytes // (t*item_bytes)))
+    else:
+        side = int(numpy.sqrt(max(1, chunk_bytes // item_bytes)))
+        t = min(shape[0], side)
+        n = min(shape[1], max(1, chunk_bytes // (t*item_bytes)))
+        t = min(shape[0], max(1, chunk_bytes // (n*item_bytes)))
+    return (int(t), int(n)) + rest
+
+
+def filter_options(args):
+    """Returns keyword arguments of create_dataset with the filters."""
+    if args.compression == 'none':
+        return {'shuffle': args.shuffle} if args.shuffle else {}
+    if args.compression == 'gzip':
+        return {'compression': 'gzip', 'compression_opts': args.compression_level, 'shuffle': args.shuffle}
+    if args.compression == 'lzf':
+        return {'compression': 'lzf', 'shuffle': args.shuffle}
+    try:
+        import hdf5plugin
+    except ImportError:
+        raise RuntimeError('--compression blosc requires hdf5plugin package')
+    return dict(hdf5plugin.Blosc(
+        cname='lz4', clevel=args.compression_level,
+        shuffle=hdf5plugin.Blosc.SHUFFLE if args.shuffle else hdf5plugin.Blosc.NOSHUFFLE))
+
+
+def copy_blocks(in_ds, out_ds, block_bytes):
+    """Copies the dataset in blocks made of whole output chunks, at most block_bytes in memory."""
+    chunks = out_ds.chunks
+    block = list(chunks)
+    itemsize = in_ds.dtype.itemsize
+    # Grows the block along time, then along particles.
+    for axis in range(min(2, len(block))):
+        while (block[axis] < in_ds.shape[axis] and
+               2*int(numpy.prod(block))*itemsize <= block_bytes):
+            block[axis] = min(in_ds.shape[axis], 2*block[axis])
+    ranges = [range(0, s, b) for s, b in zip(in_ds.shape, block)]
+    for corner in itertools.product(*ranges):
+        sel = tuple(slice(c, min(c + b, s)) for c, b, s in zip(corner, block, in_ds.shape))
+        out_ds[sel] = in_ds[sel]
+
+
+def copy_links(in_h5, out_h5, copy_dataset):
+    """Copies groups and links of in_h5 to out_h5, datasets are written by copy_dataset(name, obj).
+
+    Links are walked instead of objects (visititems visits an object only once),
+    an object linked under several paths is copied once and hard-linked to the others.
+    """
+    first_path = {}
+
+    def walk(group, prefix):
+        for key in group:
+            name = prefix + key
+            link = group.get(key, getlink=True)
+            if isinstance(link, (h5py.SoftLink, h5py.ExternalLink)):
+                out_h5[name] = link
+                continue
+            obj = group[key]
+            if obj.id in first_path:
+                out_h5[name] = out_h5[first_path[obj.id]]
+                continue
+            first_path[obj.id] = name
+            if isinstance(obj, h5py.Group):
+                out_h5.require_group(name).attrs.update(obj.attrs)
+                walk(obj, name + '/')
+            else:
+                copy_dataset(name, obj)
+
+    walk(in_h5, '')
+    out_h5.attrs.update(in_h5.attrs)
+
+
+def link_paths(h5):
+    """Returns the set of all link paths in the file."""
+    paths = set()
+
+    def walk(group, prefix):
+        for key in group:
+            paths.add(prefix + key)
+            if not isinstance(group.get(key, getlink=True), (h5py.SoftLink, h5py.ExternalLink)) and \
+                    isinstance(group[key], h5py.Group):
+                walk(group[key], prefix + key + '/')
+
+    walk(h5, '')
+    return paths
+
+
+def rechunk(in_h5, out_h5, args):
+    """Copies the file, datasets of DATA_GROUPS are written with the new layout and filters.
+
+    Hard-linked datasets are copied once and linked again.
+    """
+    filters = filter_options(args)
+    chunk_bytes = args.chunk_kb * 1024
+    block_bytes = args.block_mb * 1024**2
+    datasets = []
+
+    def copy(name, obj):
+        top = name.split('/')[0]
+        chunks = chunk_shape(obj.shape, obj.dtype.itemsize, args.layout, chunk_bytes)
+        if top not in DATA_GROUPS or chunks is None or obj.dtype.kind in 'OSUV':
+            parent, _, base = name.rpartition('/')
+            in_h5.copy(obj, out_h5[parent or '/'], name=base)
+            return
+        maxshape = obj.maxshape if obj.chunks else None
+        ds = out_h5.create_dataset(name, shape=obj.shape, dtype=obj.dtype, chunks=chunks,
+                                   maxshape=maxshape, **filters)
+        ds.attrs.update(obj.attrs)
+        datasets.append(name)
+
+    copy_links(in_h5, out_h5, copy)
+    missing = link_paths(in_h5) ^ link_paths(out_h5)
+    if missing:
+        raise RuntimeError('Output file differs in links: {}'.format(', '.join(sorted(missing))))
+    for i, name in enumerate(datasets):
+        sys.stdout.write('Copying {} ({}/{})\r'.format(name, i + 1, len(datasets)))
+        sys.stdout.flush()
+        copy_blocks(in_h5[name], out_h5[name], block_bytes)
+    print('')
+    return datasets
+
+
+def read_throughput(ds, pattern, sample_bytes=64*1024**2, time_limit=5.0):
+    """Returns MB/s of reading consecutive frames (frame) or time series of particles (particle).
+
+    Reads sample_bytes or stops after time_limit seconds.
+    """
+    if ds.ndim < 2 or ds.shape[0] == 0:
+        return float('nan')
+    if pattern == 'frame':
+        count, read = ds.shape[0], lambda i: ds[i]
+    else:
+        count, read = ds.shape[1], lambda i: ds[:, i]
+    total = 0
+    time0 = time.time()
+    for i in range(count):
+        total += read(i).nbytes
+        if total >= sample_bytes or time.time() - time0 > time_limit:
+            break
+    return total / max(time.time() - time0, 1e-9) / 1024**2
+
+
+def _layout_info(ds):
+    filters = ds.compression or 'none'
+    if ds.shuffle:
+        filters += '+shuffle'
+    return 'chunks={} filter={}'.format(ds.chunks, filters)
+
+
+def _benchmark_names(h5):
+    names = []
+    h5.visititems(lambda name, obj: names.append(name) if (
+        isinstance(obj, h5py.Dataset) and name.startswith('particles/') and name.endswith('/value') and
+        obj.ndim >= 2) else None)
+    return names
+
+
+def _benchmark(ds):
+    return read_throughput(ds, 'frame'), read_throughput(ds, 'particle')
+
+
+def main():
+    args = _args()
+    in_h5 = h5py.File(args.in_file, 'r')
+
+    # The source is measured before the copy reads it into the page cache.
+    before = {}
+    if not args.no_benchmark:
+        before = dict((name, _benchmark(in_h5[name])) for name in _benchmark_names(in_h5))
+
+    out_h5 = h5py.File(args.out_file, 'w')
+    time0 = time.time()
+    datasets = rechunk(in_h5, out_h5, args)
+    out_h5.flush()
+    print('Copied {} datasets in {:.1f}s'.format(len(datasets), time.time() - time0))
+
+    if before:
+        print('Read throughput in MB/s (frame: consecutive frames, particle: time series of particles)')
+        print('before: source, measured before the copy; after: output, measured right after writing it')
+        print('(the OS page cache is not dropped, the output may be served from memory)')
+        for name in sorted(before):
+            print(name)
+            for label, h5, result in (('before', in_h5, before[name]),
+                                      ('after', out_h5, _benchmark(out_h5[name]))):
+                print('  {:6s} frame: {:10.1f} particle: {:10.1f}  {}'.format(
+                    label, result[0], result[1], _layout_info(h5[name])))
+    in_h5.close()
+    out_h5.close()
+    print('Saved in {}'.format(args.out_file))
+
+
+if __name__ == '__main__':
+    main()
@@ -19,57 +19,262 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import argparse
 import h5py
+import multiprocessing as mp
+import numpy
 import sys
 
+try:
+    input = raw_input
+except NameError:
+    pass
+
 
 def _args():
     parser = argparse.ArgumentParser('Sort H5MD file according to /id dataset')
     parser.add_argument('in_file')
-    parser.add_argument('--force', action='store_true', default=False)
+    parser.add_argument('--force', action='store_true', default=False,
+                        help='Sort even if the file was already sorted, do not ask')
+    parser.add_argument('--yes', '-y', action='store_true', default=False,
+                        help='Do not ask, already sorted files are skipped without --force')
+    parser.add_argument('--output', help='Write sorted data to the new file, the input is not modified')
+    parser.add_argument('--chunk_frames', type=int, default=None,
+                        help='Number of frames in the chunk of sorted datasets (only with --output)')
+    parser.add_argument('--block_size', type=int, default=None,
+                        help='Number of frames read at once (rounded to the chunk size)')
+    parser.add_argument('--nt', type=int, default=1,
+                        help='Number of processes reading and sorting blocks (only with --output)')
     return parser.parse_args()
 
-def sort_file(h5):
-    atom_groups = [ag for ag in h5['/particles'] if 'id' in h5['/particles/{}/'.format(ag)]]
-    T = len(h5['/particles/{}/id/value'.format(atom_groups[0])])
-    # Iterate over time frames.
-    for t in xrange(T):
-        sys.stdout.write('Progress: {:.2f} %\r'.format(100.0*float(t)/T))
+
+def _permutation(ids):
+    """Returns (T, N) column permutations that sort ids, -1 (padding) at the end."""
+    key = numpy.where(ids == -1, numpy.iinfo(ids.dtype).max, ids)
+    permutation = numpy.empty(key.shape, dtype=numpy.intp)
+    permutation[:] = numpy.arange(key.shape[1])
+    unsorted = numpy.any(key[:, 1:] < key[:, :-1], axis=1)
+    if unsorted.any():
+        permutation[unsorted] = numpy.argsort(key[unsorted], axis=1, kind='mergesort')
+    return permutation
+
+
+def _lcm(a, b):
+    x, y = a, b
+    while y:
+        x, y = y, x % y
+    return a*b // x
+
+
+def _blocks(num_frames, chunk, block_size):
+    step = chunk * max(1, (block_size or chunk) // chunk)
+    return [(s, min(s + step, num_frames)) for s in range(0, num_frames, step)]
+
+
+def sorting_tasks(h5, chunk_frames=None, block_size=None):
+    """Returns the list of tasks (group, dataset paths, start, stop, id frames).
+
+    Datasets with the same time grid as id/value are sorted together with one
+    permutation per block, other time-dependent datasets get permutations of the
+    id frames with the same time. They come first, so that in-place sorting
+    reads the original ids.
+    """
+    same_grid_tasks, other_tasks = [], []
+    for ag in h5['/particles']:
+        group = h5['/particles/{}'.format(ag)]
+        # Only the id time element (id/{value,time}) defines the order of columns.
+        if not isinstance(group.get('id'), h5py.Group) or 'value' not in group['id'] or 'time' not in group['id']:
+            continue
+        ids_time = numpy.array(group['id/time'])
+        num_columns = group['id/value'].shape[1]
+        same_grid = []
+        for k in group:
+            if not isinstance(group[k], h5py.Group) or 'value' not in group[k] or 'time' not in group[k]:
+                continue
+            value = group[k]['value']
+            if value.ndim < 2 or value.shape[1] != num_columns or group[k]['time'].shape in ((), (0,)):
+                continue
+            ds_time = numpy.array(group[k]['time'])
+            path = '/particles/{}/{}/value'.format(ag, k)
+            chunk = _lcm(value.chunks[0] if value.chunks else 1, chunk_frames or 1)
+            if numpy.array_equal(ds_time, ids_time):
+                same_grid.append(path)
+                continue
+            # Id frame with the same time, -1 if not there.
+            id_frames = numpy.searchsorted(ids_time, ds_time)
+            id_frames[id_frames >= len(ids_time)] = 0
+            id_frames = numpy.where(ids_time[id_frames] == ds_time, id_frames, -1)
+            for start, stop in _blocks(len(ds_time), chunk, block_size):
+                other_tasks.append((ag, [path], start, stop, id_frames[start:stop]))
+        if same_grid:
+            value = h5[same_grid[0]]
+            chunk = _lcm(value.chunks[0] if value.chunks else 1, chunk_frames or 1)
+            for start, stop in _blocks(len(ids_time), chunk, block_size):
+                same_grid_tasks.append((ag, same_grid, start, stop, numpy.arange(start, stop)))
+    return other_tasks + same_grid_tasks
+
+
+def sort_block(h5, task):
+    """Returns the datasets of the task sorted in the frame range."""
+    ag, paths, start, stop, id_frames = task
+    ids = h5['/particles/{}/id/value'.format(ag)]
+    has_ids = id_frames != -1
+    permutation = numpy.empty((stop - start, ids.shape[1]), dtype=numpy.intp)
+    permutation[:] = numpy.arange(ids.shape[1])
+    if has_ids.any():
+        first, last = id_frames[has_ids].min(), id_frames[has_ids].max()
+        permutation[has_ids] = _permutation(ids[first:last+1][id_frames[has_ids] - first])
+    output = []
+    for path in paths:
+        block = h5[path][start:stop]
+        perm = permutation.reshape(permutation.shape + (1,)*(block.ndim - 2))
+        output.append(numpy.take_along_axis(block, perm, axis=1))
+    return output
+
+
+_worker_h5 = None
+
+
+def _init_worker(file_name):
+    global _worker_h5
+    _worker_h5 = h5py.File(file_name, 'r')
+
+
+def _sort_block_worker(task):
+    return sort_block(_worker_h5, task)
+
+
+def copy_links(h5, out_h5, copy_dataset):
+    """Copies groups and links of h5 to out_h5, datasets are written by copy_dataset(name, obj).
+
+    Links are walked instead of objects (visititems visits an object only once),
+    an object linked under several paths is copied once and hard-linked to the others.
+    """
+    first_path = {}
+
+    def walk(group, prefix):
+        for key in group:
+            name = prefix + key
+            link = group.get(key, getlink=True)
+            if isinstance(link, (h5py.SoftLink, h5py.ExternalLink)):
+                out_h5[name] = link
+                continue
+            obj = group[key]
+            if obj.id in first_path:
+                out_h5[name] = out_h5[first_path[obj.id]]
+                continue
+            first_path[obj.id] = name
+            if isinstance(obj, h5py.Group):
+                out_h5.require_group(name).attrs.update(obj.attrs)
+                walk(obj, name + '/')
+            else:
+                copy_dataset(name, obj)
+
+    walk(h5, '')
+    out_h5.attrs.update(h5.attrs)
+
+
+def link_paths(h5):
+    """Returns the set of all link paths in the file."""
+    paths = set()
+
+    def walk(group, prefix):
+        for key in group:
+            paths.add(prefix + key)
+            if not isinstance(group.get(key, getlink=True), (h5py.SoftLink, h5py.ExternalLink)) and \
+                    isinstance(group[key], h5py.Group):
+                walk(group[key], prefix + key + '/')
+
+    walk(h5, '')
+    return paths
+
+
+def prepare_output(h5, out_h5, paths, chunk_frames=None):
+    """Copies the input file, datasets in paths are created empty (to be sorted)."""
+    paths = set(p.lstrip('/') for p in paths)
+
+    def copy(name, obj):
+        if name in paths:
+            chunks = obj.chunks
+            if chunk_frames:
+                chunks = (max(1, min(chunk_frames, obj.shape[0])),) + obj.shape[1:]
+            ds = out_h5.create_dataset(
+                name, shape=obj.shape, dtype=obj.dtype, chunks=chunks,
+                maxshape=obj.maxshape if chunks else None,
+                compression=obj.compression, compression_opts=obj.compression_opts,
+                shuffle=obj.shuffle)
+            ds.attrs.update(obj.attrs)
+        else:
+            parent, _, base = name.rpartition('/')
+            h5.copy(obj, out_h5[parent or '/'], name=base)
+
+    copy_links(h5, out_h5, copy)
+    missing = link_paths(h5) ^ link_paths(out_h5)
+    if missing:
+        raise RuntimeError('Output file differs in links: {}'.format(', '.join(sorted(missing))))
+
+
+def sort_file(h5, out_h5=None, chunk_frames=None, block_size=None, nt=1, file_name=None):
+    """Sorts the H5MD file in place or into out_h5.
+
+    Every task is read as a chunk-aligned block, sorted and written once. With
+    out_h5 and nt > 1 blocks are read and sorted by a pool of processes, the
+    data are written only by this process.
+    """
+    tasks = sorting_tasks(h5, chunk_frames if out_h5 is not None else None, block_size)
+    if out_h5 is None:
+        out_h5 = h5
+    else:
+        prepare_output(h5, out_h5, set(p for t in tasks for p in t[1]), chunk_frames)
+
+    pool = None
+    if nt > 1 and out_h5 is not h5:
+        pool = mp.Pool(nt, initializer=_init_worker, initargs=(file_name, ))
+    for window in range(0, len(tasks), max(1, 2*nt)):
+        window_tasks = tasks[window:window + max(1, 2*nt)]
+        if pool is not None:
+            results = pool.map(_sort_block_worker, window_tasks)
+        else:
+            results = [sort_block(h5, t) for t in window_tasks]
+        for (ag, paths, start, stop, _), blocks in zip(window_tasks, results):
+            for path, block in zip(paths, blocks):
+                out_h5[path][start:stop] = block
+        sys.stdout.write('Progress: {:.2f} %\r'.format(100.0*(window + len(window_tasks))/len(tasks)))
         sys.stdout.flush()
-        for ag in atom_groups:  # Iterate over atom_groups
-            # Create sorted id mapping.
-            ids = h5['/particles/{}/id/value'.format(ag)]
-            ids_time = h5['/particles/{}/id/time'.format(ag)][t]
-            idd = [
-                x[1] for x in sorted(
-                    [(p_id, col_id) for col_id, p_id in enumerate(ids[t])],
-                    key=lambda y: (True, y[0]) if y[0] == -1 else (False, y[0]))
-                ]
-            # Iterate over group with value dataset and sort it according to particle.
-            for k in h5['/particles/{}/'.format(ag)].keys():
-                if 'value' in h5['/particles/{}/{}'.format(ag, k)].keys():
-                    ds_time = h5['/particles/{}/{}/time'.format(ag, k)]
-                    if ds_time.shape[0] == 0:
-                        continue
-                    ds_time = ds_time[t]
-                    if ds_time == ids_time:
-                        path = '/particles/{}/{}/value'.format(ag, k)
-                        h5[path][t] = h5[path][t][idd]
+    if pool is not None:
+        pool.close()
+        pool.join()
+    print('')
+
+
+def _ask(question, args):
+    """Asks on terminal, with --yes the answer is yes. Batch jobs without --yes get no."""
+    if args.yes:
+        return True
+    if not sys.stdin.isatty():
+        print('Not running in a terminal, use --yes or --force to modify the file in place')
+        return False
+    return input(question) == 'yes'
+
 
 def main():
     args = _args()
-    h5 = h5py.File(args.in_file, 'r+')
+    h5 = h5py.File(args.in_file, 'r' if args.output else 'r+')
 
     if 'sorted' in h5.attrs and not args.force:
-        yn = raw_input('Warning, file was already sorted. Do you want to repeat it? (yes/no)')
-        if yn == 'no':
+        if args.yes or not sys.stdin.isatty():
+            print('File {} was already sorted, use --force to repeat it'.format(args.in_file))
+            return False
+        if not _ask('Warning, file was already sorted. Do you want to repeat it? (yes/no)', args):
             return False
 
-    if not args.force:
-        yn = raw_input('Do you want to sort file {}? (yes/no): '.format(args.in_file))
-    else:
-        yn = 'yes'
-    if yn == 'yes':
-        sort_file(h5)
+    if args.output:
+        out_h5 = h5py.File(args.output, 'w')
+        sort_file(h5, out_h5, args.chunk_frames, args.block_size, args.nt, args.in_file)
+        out_h5['/'].attrs['sorted'] = True
+        out_h5.close()
+        h5.close()
+        print('File {} sorted to {}'.format(args.in_file, args.output))
+    elif args.force or _ask('Do you want to sort file {}? (yes/no): '.format(args.in_file), args):
+        sort_file(h5, block_size=args.block_size)
         h5['/'].attrs['sorted'] = True
         h5.close()
         print('File {} sorted, closing'.format(args.in_file))
@@ -26,13 +26,23 @@ and modified but the original file has the following copyright header:
  LICENSE file).
 """
 
+import multiprocessing
 import numpy as np
 cimport numpy as np
 import itertools
 from libc.math cimport sqrt, floor
 cimport cython
+from cython.parallel cimport prange, threadid
 
-def compute_rdf(r1, r2, L, N, cutoff, do_normalize=False):
+
+def get_num_threads(num_threads):
+    """Returns the number of OpenMP threads, values < 1 mean all available CPUs."""
+    if num_threads is None or num_threads < 1:
+        return multiprocessing.cpu_count()
+    return int(num_threads)
+
+
+def compute_rdf(r1, r2, L, N, cutoff, do_normalize=False, algorithm='brute', num_threads=1):
     """
     Compute the radial distribution function (rdf).
 
@@ -44,6 +54,9 @@ def compute_rdf(r1, r2, L, N, cutoff, do_normalize=False):
     L: [3] sides of a cuboid box
     N: nbins
     do_normalize: Do normalization ?
+    algorithm: 'brute' compares all pairs, 'cells' uses the linked-cell list
+        (falls back to 'brute' if the box holds less than 3 cells in any direction)
+    num_threads: number of OpenMP threads (< 1 means all CPUs)
 
     Returns
     -------
@@ -54,6 +67,7 @@ def compute_rdf(r1, r2, L, N, cutoff, do_normalize=False):
     cdef int i, n_rdf, n_idx,npart
     cdef double[3] cy_L
     cdef double vol,norm,phi
+    cdef int nt = get_num_threads(num_threads)
     vol = 1.0
     for i in range(3):
         cy_L[i] = L[i]
@@ -65,10 +79,18 @@ def compute_rdf(r1, r2, L, N, cutoff, do_normalize=False):
         x_max = cutoff
     dx = x_max/N
 
-    if r2 is not None:
-        result = _compute_rdf_multi(r1, r2, cy_L, N, dx)
+    if algorithm not in ('brute', 'cells'):
+        raise ValueError('Unknown algorithm {}'.format(algorithm))
+
+    if algorithm == 'cells':
+        if r2 is not None:
+            result = _compute_rdf_multi_cells(r1, r2, cy_L, N, dx, nt)
+        else:
+            result = _compute_rdf_cells(r1, cy_L, N, dx, nt)
+    elif r2 is not None:
+        result = _compute_rdf_multi(r1, r2, cy_L, N, dx, nt)
     else:
-        result = _compute_rdf(r1, cy_L, N, dx)
+        result = _compute_rdf(r1, cy_L, N, dx, nt)
 
     result = np.asarray(result)
     #if do_normalize:
@@ -77,45 +99,43 @@ def compute_rdf(r1, r2, L, N, cutoff, do_normalize=False):
     #    result /= norm
     return dx, result
 
+
 @cython.boundscheck(False)
 @cython.wraparound(False)
 @cython.cdivision(True)
-cdef _compute_rdf_multi(double[:, ::1] r1, double[:, ::1] r2, double[3] L, int N, double dx):
-    cdef int i, j, coord, idx, si, sj, rdf_idx, n_idx
+cdef _compute_rdf_multi(double[:, ::1] r1, double[:, ::1] r2, double[3] L, int N, double dx, int num_threads):
+    cdef int i, j, coord, idx, tid
     cdef double dist
     cdef double dist_sqr
     cdef double inv_dx = 1./dx
     cdef double x_max_sqr = (N*dx)**2
-    cdef double pi = np.pi
-    cdef double k
-
-    cdef double[::1] result = np.zeros(N)
 
-    for i in range(r1.shape[0]):
-        si = 0
-        for j in range(r2.shape[0]):
-            dist_sqr = 0.0
-            if all([r1[i, c] == r2[j, c] for c in range(3)]):
-                continue
-            for coord in range(3):
-                dist = r1[i,coord]-r2[j,coord]
-                if dist<-L[coord]/2.:
-                    dist += L[coord]
-                elif dist>L[coord]/2.:
-                    dist -= L[coord]
-                dist_sqr += dist**2
-            if dist_sqr <= x_max_sqr:
-                idx = int(floor(sqrt(dist_sqr)*inv_dx))
-                result[idx] += 1
-
-    k = 4.0*pi
-    for i in range(result.shape[0]):
-        result[i] /= (k*((i+0.5)*dx)**2)
-
-    return result
-
-
-def compute_rdf_index(pos, index_pairs, L, N, cutoff, do_normalize=False):
+    # Every thread fills its own histogram, reduced at the end.
+    cdef double[:, ::1] local_result = np.zeros((num_threads, N))
+
+    with nogil:
+        for i in prange(r1.shape[0], num_threads=num_threads, schedule='static'):
+            tid = threadid()
+            for j in range(r2.shape[0]):
+                if r1[i, 0] == r2[j, 0] and r1[i, 1] == r2[j, 1] and r1[i, 2] == r2[j, 2]:
+                    continue
+                dist_sqr = 0.0
+                for coord in range(3):
+                    dist = r1[i,coord]-r2[j,coord]
+                    if dist<-L[coord]/2.:
+                        dist = dist + L[coord]
+                    elif dist>L[coord]/2.:
+                        dist = dist - L[coord]
+                    dist_sqr = dist_sqr + dist*dist
+                if dist_sqr <= x_max_sqr:
+                    idx = <int>floor(sqrt(dist_sqr)*inv_dx)
+                    if idx < N:
+                        local_result[tid, idx] += 1
+
+    return _reduce_normalize_shell(local_result, dx, 4.0*np.pi)
+
+
+def compute_rdf_index(pos, index_pairs, L, N, cutoff, do_normalize=False, num_threads=1):
     cdef int i, n_rdf, n_idx,npart
     cdef double[3] cy_L
     cdef double vol,norm,phi
@@ -128,7 +148,7 @@ def compute_rdf_index(pos, index_pairs, L, N, cutoff, do_normalize=False):
         x_max = cutoff
     dx = x_max/N
 
-    result = _compute_rdf_multi_idx(pos, index_pairs, cy_L, N, dx)
+    result = _compute_rdf_multi_idx(pos, index_pairs, cy_L, N, dx, get_num_threads(num_threads))
 
     result = np.asarray(result)
     #if do_normalize:
@@ -139,84 +159,513 @@ def compute_rdf_index(pos, index_pairs, L, N, cutoff, do_normalize=False):
 
 
 cpdef compute_pairs(int[::1] input_pairs):
+    """Builds the flat list of all pairs, O(n^2) memory. Use compute_rdf_groups for large selections."""
     return np.asarray([x for l in list(itertools.combinations_with_replacement(input_pairs, 2)) for x in l], dtype=np.int32)
 
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
 @cython.cdivision(True)
-cdef _compute_rdf_multi_idx(double[:, ::1] pos, int[::1] index_pairs, double[3] L, int N, double dx):
-    cdef int i, j, coord, idx, si, sj, rdf_idx, n_idx
+cdef _compute_rdf_multi_idx(double[:, ::1] pos, int[::1] index_pairs, double[3] L, int N, double dx, int num_threads):
+    cdef int i, j, coord, idx, tid
     cdef double dist
     cdef double dist_sqr
     cdef double inv_dx = 1./dx
     cdef double x_max_sqr = (N*dx)**2
-    cdef double pi = np.pi
-    cdef double k
 
     cdef double[3] L2
     for i in range(3):
         L2[i] = 0.5*L[i]
 
-    cdef double[::1] result = np.zeros(N)
+    cdef double[:, ::1] local_result = np.zeros((num_threads, N))
 
     cdef int pidx
-    for pidx in range(index_pairs.shape[0]/2):
-        i = index_pairs[pidx]
-        j = index_pairs[pidx+1]
-        dist_sqr = 0.0
-        for coord in range(3):
-            dist = pos[i, coord] - pos[j, coord]
-            if dist < -L2[coord]:
-                dist += L[coord]
-            elif dist > L2[coord]:
-                dist -= L[coord]
-            dist_sqr += dist**2
-        if dist_sqr <= x_max_sqr:
-            idx = int(floor(sqrt(dist_sqr)*inv_dx))
-            result[idx] += 1
-
-    k = 4.0*pi
-    for i in range(result.shape[0]):
-        result[i] /= (k*((i+0.5)*dx)**2)
+    with nogil:
+        for pidx in prange(index_pairs.shape[0] // 2, num_threads=num_threads, schedule='static'):
+            tid = threadid()
+            i = index_pairs[2*pidx]
+            j = index_pairs[2*pidx+1]
+            dist_sqr = 0.0
+            for coord in range(3):
+                dist = pos[i, coord] - pos[j, coord]
+                if dist < -L2[coord]:
+                    dist = dist + L[coord]
+                elif dist > L2[coord]:
+                    dist = dist - L[coord]
+                dist_sqr = dist_sqr + dist*dist
+            if dist_sqr <= x_max_sqr:
+                idx = <int>floor(sqrt(dist_sqr)*inv_dx)
+                if idx < N:
+                    local_result[tid, idx] += 1
+
+    return _reduce_normalize_shell(local_result, dx, 4.0*np.pi)
 
-    return result
+
+def exclusion_list(bonds, num_particles):
+    """Converts the list of excluded pairs into CSR format used by compute_rdf_groups.
+
+    Arguments
+    ---------
+
+    bonds: [M, 2] array of excluded pairs of particle indexes
+    num_particles: total number of particles (length of the position array)
+
+    Returns
+    -------
+
+    offsets is [num_particles+1] array, the excluded partners of particle i
+    are neighbours[offsets[i]:offsets[i+1]]
+    """
+    bonds = np.asarray(bonds, dtype=np.int32).reshape(-1, 2)
+    first = np.concatenate([bonds[:, 0], bonds[:, 1]])
+    second = np.concatenate([bonds[:, 1], bonds[:, 0]])
+    order = np.argsort(first, kind='mergesort')
+    offsets = np.zeros(num_particles+1, dtype=np.int32)
+    offsets[1:] = np.cumsum(np.bincount(first, minlength=num_particles))
+    return offsets, np.ascontiguousarray(second[order], dtype=np.int32)
+
+
+def compute_rdf_groups(pos, index1, index2, L, N, cutoff, mol_id=None, exclusions=None,
+                       algorithm='cells', num_threads=1):
+    """
+    Compute the RDF between groups of particles selected by indexes.
+
+    The pairs are generated inside the kernel, so the memory depends only
+    on the size of the selection.
+
+    Arguments
+    ---------
+
+    pos: [num, 3] array of positions
+    index1: [n1] indexes of particles of the first group
+    index2: [n2] indexes of particles of the second group, None for pairs within the first group
+    L: [3] sides of a cuboid box
+    N: nbins
+    mol_id: [num] molecule id of every particle, pairs within the same molecule are skipped
+    exclusions: (offsets, neighbours) from exclusion_list, these pairs are skipped
+    algorithm: 'brute' or 'cells', the same as in compute_rdf
+    num_threads: number of OpenMP threads (< 1 means all CPUs)
+
+    Returns
+    -------
+
+    dx is the radius step
+    result is [N] array, normalized the same way as compute_rdf
+    """
+    cdef int i
+    cdef double[3] cy_L
+    for i in range(3):
+        cy_L[i] = L[i]
+
+    if cutoff == -1:
+        x_max = np.min(L)/2.
+    else:
+        x_max = cutoff
+    dx = x_max/N
+
+    if algorithm not in ('brute', 'cells'):
+        raise ValueError('Unknown algorithm {}'.format(algorithm))
+
+    pos = np.ascontiguousarray(pos, dtype=np.double)
+    index1 = np.ascontiguousarray(index1, dtype=np.int32)
+    same_group = index2 is None
+    if same_group:
+        index2 = index1
+    else:
+        index2 = np.ascontiguousarray(index2, dtype=np.int32)
+
+    empty = np.zeros(0, dtype=np.int32)
+    if mol_id is None:
+        mol_id = empty
+    if exclusions is None:
+        exclusions = (empty, empty)
+
+    result = _compute_rdf_groups(
+        pos, index1, index2, np.ascontiguousarray(mol_id, dtype=np.int32),
+        exclusions[0], exclusions[1], cy_L, N, dx, get_num_threads(num_threads),
+        same_group, algorithm == 'cells')
+    return dx, np.asarray(result)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline bint _is_excluded(int a, int b, int[::1] offsets, int[::1] neighbours) nogil:
+    cdef int k
+    for k in range(offsets[a], offsets[a+1]):
+        if neighbours[k] == b:
+            return True
+    return False
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef _compute_rdf_groups(double[:, ::1] pos, int[::1] index1, int[::1] index2, int[::1] mol_id,
+                         int[::1] excl_offsets, int[::1] excl_neighbours, double[3] L, int N, double dx,
+                         int num_threads, bint same_group, bint use_cells):
+    cdef int i, j, a, b, ox, oy, oz, cx, cy, cz, idx, tid
+    cdef double dist_sqr
+    cdef double inv_dx = 1./dx
+    cdef double x_max_sqr = (N*dx)**2
+    cdef bint use_mol = mol_id.shape[0] > 0
+    cdef bint use_excl = excl_offsets.shape[0] > 0
+    cdef int[3] n_cells
+
+    cdef double[:, ::1] local_result = np.zeros((num_threads, N))
+
+    if use_cells:
+        use_cells = _get_cell_grid(L, N*dx, n_cells)
+    if not use_cells:
+        n_cells[0] = n_cells[1] = n_cells[2] = 1
+
+    # Cell list is built on the positions of the second group only.
+    cdef int[::1] head = np.empty(n_cells[0]*n_cells[1]*n_cells[2], dtype=np.int32)
+    cdef int[::1] next_particle = np.empty(index2.shape[0], dtype=np.int32)
+    if use_cells:
+        _build_cells(np.ascontiguousarray(np.asarray(pos)[np.asarray(index2)]), L, n_cells, head, next_particle)
+
+    with nogil:
+        for i in prange(index1.shape[0], num_threads=num_threads, schedule='dynamic', chunksize=64):
+            tid = threadid()
+            a = index1[i]
+            if use_cells:
+                cx = _cell_coord(pos[a, 0], L[0], n_cells[0])
+                cy = _cell_coord(pos[a, 1], L[1], n_cells[1])
+                cz = _cell_coord(pos[a, 2], L[2], n_cells[2])
+                for ox in range(cx - 1, cx + 2):
+                    for oy in range(cy - 1, cy + 2):
+                        for oz in range(cz - 1, cz + 2):
+                            j = head[_neighbour_cell(ox, oy, oz, n_cells)]
+                            while j != -1:
+                                b = index2[j]
+                                if ((not same_group or j > i) and a != b
+                                        and not (use_mol and mol_id[a] == mol_id[b])
+                                        and not (use_excl and _is_excluded(a, b, excl_offsets, excl_neighbours))):
+                                    dist_sqr = _pbc_distance_sqr(pos, a, pos, b, L)
+                                    if dist_sqr <= x_max_sqr:
+                                        idx = <int>floor(sqrt(dist_sqr)*inv_dx)
+                                        if idx < N:
+                                            local_result[tid, idx] += 1
+                                j = next_particle[j]
+            else:
+                for j in range(i+1 if same_group else 0, index2.shape[0]):
+                    b = index2[j]
+                    if a == b:
+                        continue
+                    if use_mol and mol_id[a] == mol_id[b]:
+                        continue
+                    if use_excl and _is_excluded(a, b, excl_offsets, excl_neighbours):
+                        continue
+                    dist_sqr = _pbc_distance_sqr(pos, a, pos, b, L)
+                    if dist_sqr <= x_max_sqr:
+                        idx = <int>floor(sqrt(dist_sqr)*inv_dx)
+                        if idx < N:
+                            local_result[tid, idx] += 1
+
+    return _reduce_normalize_shell(local_result, dx, 2.0*np.pi if same_group else 4.0*np.pi)
 
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
 @cython.cdivision(True)
-cdef _compute_rdf(double[:, ::1] r1, double[3] L, int N, double dx):
-    cdef int i, j, coord, idx, si, sj, rdf_idx, n_idx
+cdef _compute_rdf(double[:, ::1] r1, double[3] L, int N, double dx, int num_threads):
+    cdef int i, j, coord, idx, tid
     cdef double dist
     cdef double dist_sqr
     cdef double inv_dx = 1./dx
     cdef double x_max_sqr = (N*dx)**2
-    cdef double pi = np.pi
-    cdef double k
 
-    cdef double[::1] result = np.zeros(N)
+    cdef double[:, ::1] local_result = np.zeros((num_threads, N))
+
+    with nogil:
+        # The inner loop shrinks with i, dynamic schedule keeps threads balanced.
+        for i in prange(r1.shape[0], num_threads=num_threads, schedule='dynamic', chunksize=64):
+            tid = threadid()
+            for j in range(i+1, r1.shape[0]):
+                dist_sqr = 0.0
+                for coord in range(3):
+                    dist = r1[i,coord]-r1[j,coord]
+                    if dist<-L[coord]/2.:
+                        dist = dist + L[coord]
+                    elif dist>L[coord]/2.:
+                        dist = dist - L[coord]
+                    dist_sqr = dist_sqr + dist*dist
+                if dist_sqr <= x_max_sqr:
+                    idx = <int>floor(sqrt(dist_sqr)*inv_dx)
+                    if idx < N:
+                        local_result[tid, idx] += 1
+
+    return _reduce_normalize_shell(local_result, dx, 2.0*np.pi)
+
+
+@cython.cdivision(True)
+cdef inline int _cell_coord(double x, double L, int n_cells) nogil:
+    """Returns the cell coordinate of x along the periodic side L."""
+    cdef double s = x/L
+    cdef int c
+    s -= floor(s)
+    c = <int>(s*n_cells)
+    if c >= n_cells:
+        c = n_cells - 1
+    return c
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef inline double _pbc_distance_sqr(double[:, ::1] r1, int i, double[:, ::1] r2, int j, double *L) nogil:
+    """Squared minimum image distance between r1[i] and r2[j]."""
+    cdef double dist
+    cdef double dist_sqr = 0.0
+    cdef int coord
+    for coord in range(3):
+        dist = r1[i, coord] - r2[j, coord]
+        dist -= L[coord]*floor(dist/L[coord] + 0.5)
+        dist_sqr += dist*dist
+    return dist_sqr
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _build_cells(double[:, ::1] r, double[3] L, int *n_cells, int[::1] head, int[::1] next_particle):
+    """Sorts particles into the linked-cell list (head of each cell, next particle in the cell)."""
+    cdef int i, c
+
+    for i in range(head.shape[0]):
+        head[i] = -1
+    for i in range(r.shape[0]):
+        c = (_cell_coord(r[i, 0], L[0], n_cells[0])*n_cells[1]
+             + _cell_coord(r[i, 1], L[1], n_cells[1]))*n_cells[2] + _cell_coord(r[i, 2], L[2], n_cells[2])
+        next_particle[i] = head[c]
+        head[c] = i
 
-    for i in range(r1.shape[0]):
-        for j in range(i+1, r1.shape[0]):
-            dist_sqr = 0.0
-            for coord in range(3):
-                dist = r1[i,coord]-r1[j,coord]
-                if dist<-L[coord]/2.:
-                    dist += L[coord]
-                elif dist>L[coord]/2.:
-                    dist -= L[coord]
-                dist_sqr += dist**2
-            if dist_sqr <= x_max_sqr:
-                idx = int(floor(sqrt(dist_sqr)*inv_dx))
-                result[idx] += 1
 
-    k = 2.0*pi
+cdef bint _get_cell_grid(double[3] L, double cutoff, int *n_cells):
+    """Computes the number of cells (not smaller than cutoff) in each direction.
+
+    Returns False if the box holds less than 3 cells in any direction, then the
+    27-cell stencil would visit the same cell twice and the caller has to use
+    the all-pairs kernel.
+    """
+    cdef int coord
+    for coord in range(3):
+        n_cells[coord] = int(floor(L[coord]/cutoff))
+        if n_cells[coord] < 3:
+            return False
+    return True
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef inline int _neighbour_cell(int cx, int cy, int cz, int *n_cells) nogil:
+    """Returns the flat index of the periodic image of cell (cx, cy, cz)."""
+    return (((cx + n_cells[0]) % n_cells[0])*n_cells[1]
+            + (cy + n_cells[1]) % n_cells[1])*n_cells[2] + (cz + n_cells[2]) % n_cells[2]
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef _compute_rdf_cells(double[:, ::1] r1, double[3] L, int N, double dx, int num_threads):
+    """Same as _compute_rdf but visits only the neighbouring cells."""
+    cdef int i, j, ox, oy, oz, cx, cy, cz, idx, tid
+    cdef double dist_sqr
+    cdef double inv_dx = 1./dx
+    cdef double x_max_sqr = (N*dx)**2
+    cdef int[3] n_cells
+
+    if not _get_cell_grid(L, N*dx, n_cells):
+        return _compute_rdf(r1, L, N, dx, num_threads)
+
+    cdef int[::1] head = np.empty(n_cells[0]*n_cells[1]*n_cells[2], dtype=np.int32)
+    cdef int[::1] next_particle = np.empty(r1.shape[0], dtype=np.int32)
+    _build_cells(r1, L, n_cells, head, next_particle)
+
+    cdef double[:, ::1] local_result = np.zeros((num_threads, N))
+
+    with nogil:
+        for i in prange(r1.shape[0], num_threads=num_threads, schedule='static'):
+            tid = threadid()
+            cx = _cell_coord(r1[i, 0], L[0], n_cells[0])
+            cy = _cell_coord(r1[i, 1], L[1], n_cells[1])
+            cz = _cell_coord(r1[i, 2], L[2], n_cells[2])
+            for ox in range(cx - 1, cx + 2):
+                for oy in range(cy - 1, cy + 2):
+                    for oz in range(cz - 1, cz + 2):
+                        j = head[_neighbour_cell(ox, oy, oz, n_cells)]
+                        while j != -1:
+                            if j > i:
+                                dist_sqr = _pbc_distance_sqr(r1, i, r1, j, L)
+                                if dist_sqr <= x_max_sqr:
+                                    idx = <int>floor(sqrt(dist_sqr)*inv_dx)
+                                    if idx < N:
+                                        local_result[tid, idx] += 1
+                            j = next_particle[j]
+
+    return _reduce_normalize_shell(local_result, dx, 2.0*np.pi)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef _compute_rdf_multi_cells(double[:, ::1] r1, double[:, ::1] r2, double[3] L, int N, double dx, int num_threads):
+    """Same as _compute_rdf_multi but visits only the neighbouring cells of r2."""
+    cdef int i, j, ox, oy, oz, cx, cy, cz, idx, tid
+    cdef double dist_sqr
+    cdef double inv_dx = 1./dx
+    cdef double x_max_sqr = (N*dx)**2
+    cdef int[3] n_cells
+
+    if not _get_cell_grid(L, N*dx, n_cells):
+        return _compute_rdf_multi(r1, r2, L, N, dx, num_threads)
+
+    cdef int[::1] head = np.empty(n_cells[0]*n_cells[1]*n_cells[2], dtype=np.int32)
+    cdef int[::1] next_particle = np.empty(r2.shape[0], dtype=np.int32)
+    _build_cells(r2, L, n_cells, head, next_particle)
+
+    cdef double[:, ::1] local_result = np.zeros((num_threads, N))
+
+    with nogil:
+        for i in prange(r1.shape[0], num_threads=num_threads, schedule='static'):
+            tid = threadid()
+            cx = _cell_coord(r1[i, 0], L[0], n_cells[0])
+            cy = _cell_coord(r1[i, 1], L[1], n_cells[1])
+            cz = _cell_coord(r1[i, 2], L[2], n_cells[2])
+            for ox in range(cx - 1, cx + 2):
+                for oy in range(cy - 1, cy + 2):
+                    for oz in range(cz - 1, cz + 2):
+                        j = head[_neighbour_cell(ox, oy, oz, n_cells)]
+                        while j != -1:
+                            if r1[i, 0] != r2[j, 0] or r1[i, 1] != r2[j, 1] or r1[i, 2] != r2[j, 2]:
+                                dist_sqr = _pbc_distance_sqr(r1, i, r2, j, L)
+                                if dist_sqr <= x_max_sqr:
+                                    idx = <int>floor(sqrt(dist_sqr)*inv_dx)
+                                    if idx < N:
+                                        local_result[tid, idx] += 1
+                            j = next_particle[j]
+
+    return _reduce_normalize_shell(local_result, dx, 4.0*np.pi)
+
+
+def compute_rdf_partials(pos, types, int n_types, L, N, cutoff, algorithm='cells', num_threads=1):
+    """
+    Compute all partial radial distribution functions in one pass.
+
+    Arguments
+    ---------
+
+    pos: [num, 3] array of positions
+    types: [num] array of type index (0..n_types-1) of every particle, -1 to skip the particle
+    n_types: number of types
+    L: [3] sides of a cuboid box
+    N: nbins
+    algorithm: 'brute' or 'cells', the same as in compute_rdf
+    num_threads: number of OpenMP threads (< 1 means all CPUs)
+
+    Returns
+    -------
+
+    dx is the radius step
+    result is a [n_types, n_types, N] array of pair counts (ordered pairs)
+    divided by the shell surface 4*pi*r^2
+    """
+    cdef int i
+    cdef double[3] cy_L
+    for i in range(3):
+        cy_L[i] = L[i]
+
+    if cutoff == -1:
+        x_max = np.min(L)/2.
+    else:
+        x_max = cutoff
+    dx = x_max/N
+
+    if algorithm not in ('brute', 'cells'):
+        raise ValueError('Unknown algorithm {}'.format(algorithm))
+
+    result = _compute_rdf_partials(
+        pos, np.asarray(types, dtype=np.int32), n_types, cy_L, N, dx,
+        get_num_threads(num_threads), algorithm == 'cells')
+    return dx, np.asarray(result).reshape(n_types, n_types, N)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef _compute_rdf_partials(double[:, ::1] r1, int[::1] types, int n_types, double[3] L, int N, double dx,
+                           int num_threads, bint use_cells):
+    cdef int i, j, ox, oy, oz, cx, cy, cz, idx, tid, ti, tj
+    cdef double dist_sqr
+    cdef double inv_dx = 1./dx
+    cdef double x_max_sqr = (N*dx)**2
+    cdef int[3] n_cells
+
+    # Flat [n_types, n_types, N] histogram for every thread.
+    cdef double[:, ::1] local_result = np.zeros((num_threads, n_types*n_types*N))
+
+    if use_cells:
+        use_cells = _get_cell_grid(L, N*dx, n_cells)
+    if not use_cells:
+        n_cells[0] = n_cells[1] = n_cells[2] = 1
+
+    cdef int[::1] head = np.empty(n_cells[0]*n_cells[1]*n_cells[2], dtype=np.int32)
+    cdef int[::1] next_particle = np.empty(r1.shape[0], dtype=np.int32)
+    if use_cells:
+        _build_cells(r1, L, n_cells, head, next_particle)
+
+    with nogil:
+        for i in prange(r1.shape[0], num_threads=num_threads, schedule='dynamic', chunksize=64):
+            tid = threadid()
+            ti = types[i]
+            if ti < 0:
+                continue
+            if use_cells:
+                cx = _cell_coord(r1[i, 0], L[0], n_cells[0])
+                cy = _cell_coord(r1[i, 1], L[1], n_cells[1])
+                cz = _cell_coord(r1[i, 2], L[2], n_cells[2])
+                for ox in range(cx - 1, cx + 2):
+                    for oy in range(cy - 1, cy + 2):
+                        for oz in range(cz - 1, cz + 2):
+                            j = head[_neighbour_cell(ox, oy, oz, n_cells)]
+                            while j != -1:
+                                if j > i and types[j] >= 0:
+                                    dist_sqr = _pbc_distance_sqr(r1, i, r1, j, L)
+                                    if dist_sqr <= x_max_sqr:
+                                        idx = <int>floor(sqrt(dist_sqr)*inv_dx)
+                                        if idx < N:
+                                            tj = types[j]
+                                            local_result[tid, (ti*n_types + tj)*N + idx] += 1
+                                            local_result[tid, (tj*n_types + ti)*N + idx] += 1
+                                j = next_particle[j]
+            else:
+                for j in range(i+1, r1.shape[0]):
+                    if types[j] < 0:
+                        continue
+                    dist_sqr = _pbc_distance_sqr(r1, i, r1, j, L)
+                    if dist_sqr <= x_max_sqr:
+                        idx = <int>floor(sqrt(dist_sqr)*inv_dx)
+                        if idx < N:
+                            tj = types[j]
+                            local_result[tid, (ti*n_types + tj)*N + idx] += 1
+                            local_result[tid, (tj*n_types + ti)*N + idx] += 1
+
+    result = np.sum(local_result, axis=0).reshape(n_types*n_types, N)
+    result /= 4.0*np.pi*((np.arange(N)+0.5)*dx)**2
+    return result
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef _reduce_normalize_shell(double[:, ::1] local_result, double dx, double k):
+    """Sums the per-thread histograms and divides by the shell surface k*r^2."""
+    cdef int i
+    cdef double[::1] result = np.sum(local_result, axis=0)
     for i in range(result.shape[0]):
         result[i] /= (k*((i+0.5)*dx)**2)
-
     return result
 
+
 cdef inline distance_sqr(double[::1] d1, double[::1] d2, double[3] L, double[3] L2):
     cdef double dist = 0.
     cdef double dist_sqr = 0.
@@ -230,7 +679,7 @@ cdef inline distance_sqr(double[::1] d1, double[::1] d2, double[3] L, double[3]
         dist_sqr += dist**2
     return dist_sqr
 
-def compute_nb(r1, r2, L, cutoff):
+def compute_nb(r1, r2, L, cutoff, num_threads=1):
     cdef int i
     cdef double[3] cy_L
     cdef double[3] cy_L2
@@ -238,83 +687,128 @@ def compute_nb(r1, r2, L, cutoff):
         cy_L[i] = L[i]
         cy_L2[i] = 0.5*L[i]
 
-    return _compute_nb(r1, r2, cy_L, cy_L2, cutoff**2)
-    #return _compute_nb2(r1, r2, L, cutoff)
-
-
-def compute_nb2(r1, r2, L, cutoff):
-    #cdef int i
-    #cdef double[3] cy_L
-    #cdef double[3] cy_L2
-    #for i in range(3):
-    #    cy_L[i] = L[i]
-    #    cy_L2[i] = 0.5*L[i]
-
-    #return _compute_nb(r1, r2, cy_L, cy_L2, cutoff**2)
-    return _compute_nb2(r1, r2, L, cutoff)
+    return _compute_nb(r1, r2, cy_L, cy_L2, cutoff**2, get_num_threads(num_threads))
 
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
 @cython.cdivision(True)
-cdef _compute_nb(double[:, ::1] r1, double[:, ::1] r2, double[3] L, double[3] L2, double cutoff_sqr):
+cdef _compute_nb(double[:, ::1] r1, double[:, ::1] r2, double[3] L, double[3] L2, double cutoff_sqr, int num_threads):
     cdef int i, j, coord, idx
-    cdef double dist_sqr
+    cdef double dist, dist_sqr
 
     cdef int[::1] result = np.zeros(r1.shape[0], dtype=np.int32)
 
-    for i in range(r1.shape[0]):
-        for j in range(r2.shape[0]):
-            dist_sqr = 0.0
-            for coord in range(3):
-                dist = r1[i,coord]-r2[j,coord]
-                if dist<-L2[coord]:
-                    dist += L[coord]
-                elif dist>L2[coord]:
-                    dist -= L[coord]
-                dist_sqr += dist**2
-            if dist_sqr > 0.0 and dist_sqr <= cutoff_sqr:
-                result[i] += 1
+    # Each thread owns its own rows of result, no reduction needed.
+    with nogil:
+        for i in prange(r1.shape[0], num_threads=num_threads, schedule='static'):
+            for j in range(r2.shape[0]):
+                dist_sqr = 0.0
+                for coord in range(3):
+                    dist = r1[i,coord]-r2[j,coord]
+                    if dist<-L2[coord]:
+                        dist = dist + L[coord]
+                    elif dist>L2[coord]:
+                        dist = dist - L[coord]
+                    dist_sqr = dist_sqr + dist*dist
+                if dist_sqr > 0.0 and dist_sqr <= cutoff_sqr:
+                    result[i] += 1
 
     return result
 
-cdef list directions = [-2, -1, 0, 1, 2]
-cdef np.ndarray coords = np.array([
-    (l, m, n) for l in directions for m in directions for n in directions])
 
-@cython.boundscheck(False)
-@cython.wraparound(False)
-@cython.cdivision(True)
-cdef inline _get_indexes(int i, int j, int k, double[::1] L):
-    cdef int[::1] indexes = np.array([i, j, k], dtype=np.int32)
-    return np.asarray((coords + indexes) % L, dtype=np.int)
+def compute_nb2(r1, r2, L, cutoff, return_lists=False, num_threads=1):
+    """
+    Compute the number of neighbours with the linked-cell list.
 
+    Gives the same counts as compute_nb (particles of r2 within cutoff from
+    every particle of r1, excluding zero distance), but visits only
+    the neighbouring cells. Falls back to all pairs if the box holds less
+    than 3 cells in any direction.
 
-@cython.boundscheck(False)
-@cython.wraparound(False)
-@cython.cdivision(True)
-cdef double _compute_nb2(double[:, ::1] r1, double[:, ::1] r2, np.ndarray L, double cutoff):
-    cdef int i, j, k
+    Arguments
+    ---------
+
+    r1: [n1, 3] array of positions of first group
+    r2: [n2, 3] array of positions of second group
+    L: [3] sides of a cuboid box
+    cutoff: the cutoff distance
+    return_lists: return also the neighbour lists
+    num_threads: number of OpenMP threads (< 1 means all CPUs)
 
-    cdef np.ndarray bins = np.ceil(L/(cutoff))
+    Returns
+    -------
+
+    counts is [n1] array with the number of neighbours,
+    with return_lists the tuple (counts, offsets, neighbours) where
+    neighbours[offsets[i]:offsets[i+1]] are indexes of r2 around r1[i] (CSR)
+    """
+    cdef int i
+    cdef double[3] cy_L
+    for i in range(3):
+        cy_L[i] = L[i]
 
-    #hist1, _ = np.histogramdd(np.asarray(r1), bins=bins, range=([0, L[0]], [0, L[1]], [0, L[2]]))
-    hist2, _ = np.histogramdd(np.asarray(r2), bins=bins, range=([0, L[0]], [0, L[1]], [0, L[2]]))
+    r1 = np.ascontiguousarray(r1, dtype=np.double)
+    r2 = np.ascontiguousarray(r2, dtype=np.double)
+    nt = get_num_threads(num_threads)
+    empty = np.zeros(0, dtype=np.int32)
 
-    cdef int result = 0
-    cdef np.ndarray nb_indexes
-    print bins, L, cutoff**2, np.sum(hist2)
+    counts = np.zeros(r1.shape[0], dtype=np.int32)
+    _compute_nb_cells(r1, r2, cy_L, cutoff, nt, counts, empty, empty, False)
+    if not return_lists:
+        return counts
 
-    cdef np.ndarray res = np.zeros(hist2.shape, dtype=np.long)
+    offsets = np.zeros(r1.shape[0]+1, dtype=np.int32)
+    offsets[1:] = np.cumsum(counts)
+    neighbours = np.empty(offsets[-1], dtype=np.int32)
+    _compute_nb_cells(r1, r2, cy_L, cutoff, nt, counts, offsets, neighbours, True)
+    return counts, offsets, neighbours
 
-    cdef int total = 0
 
-    for i in range(bins[0]):
-        for j in range(bins[1]):
-            for k in range(bins[2]):
-                #num_type1 = hist1[i][j][k]
-                nb_indexes = _get_indexes(i, j, k, bins)
-                for idx in nb_indexes:
-                    total += 1
-                    res[i][j][k] += hist2[idx[0]][idx[1]][idx[2]]
-    return np.average(res)
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef _compute_nb_cells(double[:, ::1] r1, double[:, ::1] r2, double[3] L, double cutoff, int num_threads,
+                       int[::1] counts, int[::1] offsets, int[::1] neighbours, bint fill):
+    """Counts neighbours, or with fill writes them to neighbours[offsets[i]:]."""
+    cdef int i, j, ox, oy, oz, cx, cy, cz, n
+    cdef double dist_sqr
+    cdef double cutoff_sqr = cutoff*cutoff
+    cdef int[3] n_cells
+    cdef bint use_cells = _get_cell_grid(L, cutoff, n_cells)
+
+    if not use_cells:
+        n_cells[0] = n_cells[1] = n_cells[2] = 1
+
+    cdef int[::1] head = np.empty(n_cells[0]*n_cells[1]*n_cells[2], dtype=np.int32)
+    cdef int[::1] next_particle = np.empty(r2.shape[0], dtype=np.int32)
+    if use_cells:
+        _build_cells(r2, L, n_cells, head, next_particle)
+
+    # Each thread owns its own rows of counts and its own CSR segments.
+    with nogil:
+        for i in prange(r1.shape[0], num_threads=num_threads, schedule='static'):
+            n = 0
+            if use_cells:
+                cx = _cell_coord(r1[i, 0], L[0], n_cells[0])
+                cy = _cell_coord(r1[i, 1], L[1], n_cells[1])
+                cz = _cell_coord(r1[i, 2], L[2], n_cells[2])
+                for ox in range(cx - 1, cx + 2):
+                    for oy in range(cy - 1, cy + 2):
+                        for oz in range(cz - 1, cz + 2):
+                            j = head[_neighbour_cell(ox, oy, oz, n_cells)]
+                            while j != -1:
+                                dist_sqr = _pbc_distance_sqr(r1, i, r2, j, L)
+                                if dist_sqr > 0.0 and dist_sqr <= cutoff_sqr:
+                                    if fill:
+                                        neighbours[offsets[i] + n] = j
+                                    n = n + 1
+                                j = next_particle[j]
+            else:
+                for j in range(r2.shape[0]):
+                    dist_sqr = _pbc_distance_sqr(r1, i, r2, j, L)
+                    if dist_sqr > 0.0 and dist_sqr <= cutoff_sqr:
+                        if fill:
+                            neighbours[offsets[i] + n] = j
+                        n = n + 1
+            counts[i] = n
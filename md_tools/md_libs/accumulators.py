@@ -0,0 +1,182 @@
+"""
+Copyright (C) 2017 Jakub Krajniak <jkrajniak@gmail.com>
+
+This file is part of lab-tools.
+
+lab-tools is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import json
+import numpy
+import os
+
+__doc__ = "Running accumulators of analysis results that can be checkpointed."
+
+
+class RDFAccumulator(object):
+    """Running sum of RDF histograms over frames.
+
+    The accumulator can be saved to a small .npz checkpoint and loaded again
+    to continue with the frames that were not processed yet (e.g. frames
+    appended later with h5md_merge).
+    """
+
+    def __init__(self, settings=None):
+        """Creates empty accumulator.
+
+        Args:
+          settings: The dictionary with analysis settings (bins, cutoff, types, ...),
+            checked when the accumulator is resumed.
+        """
+        self.settings = json.loads(json.dumps(settings or {}))
+        self.histogram = None
+        self.pair_count = None
+        self.x = None
+        self.n_frames = 0
+        self.next_frame = 0
+
+    def add(self, histogram, x, n_frames, next_frame, pair_count=0.0):
+        """Adds the sum of histograms of a consecutive range of frames.
+
+        Args:
+          histogram: The sum of per-frame histograms.
+          x: The bin centres.
+          n_frames: The number of frames in the sum.
+          next_frame: The first frame that was not processed yet.
+          pair_count: The sum of per-frame pair counts (N1*N2).
+        """
+        if self.histogram is None:
+            self.histogram = numpy.zeros_like(histogram, dtype=numpy.double)
+            self.pair_count = numpy.zeros_like(pair_count, dtype=numpy.double)
+        if x is not None:
+            self.x = numpy.asarray(x)
+        self.histogram += histogram
+        self.pair_count += pair_count
+        self.n_frames += n_frames
+        self.next_frame = next_frame
+
+    @property
+    def rdf(self):
+        """The RDF averaged over all accumulated frames."""
+        return self.histogram / float(self.n_frames)
+
+    def check_settings(self, settings):
+        """Raises RuntimeError if settings differ from those of the accumulator."""
+        settings = json.loads(json.dumps(settings))
+        if settings != self.settings:
+            raise RuntimeError('Checkpoint settings {} differ from {}'.format(self.settings, settings))
+
+    def save(self, file_name):
+        """Saves the accumulator, the old checkpoint is replaced only when the new one is written."""
+        tmp_file_name = '{}.tmp.npz'.format(file_name)
+        numpy.savez(
+            tmp_file_name,
+            histogram=self.histogram,
+            pair_count=self.pair_count,
+            x=self.x if self.x is not None else numpy.zeros(0),
+            n_frames=self.n_frames,
+            next_frame=self.next_frame,
+            settings=json.dumps(self.settings))
+        os.rename(tmp_file_name, file_name)
+
+    @classmethod
+    def load(cls, file_name):
+        """Loads the accumulator from the checkpoint file."""
+        with numpy.load(file_name) as data:
+            acc = cls(json.loads(str(data['settings'])))
+            acc.histogram = data['histogram']
+            acc.pair_count = data['pair_count']
+            acc.x = data['x'] if data['x'].size else None
+            acc.n_frames = int(data['n_frames'])
+            acc.next_frame = int(data['next_frame'])
+        return acc
+
+
+class HistogramAccumulator(object):
+    """Fixed-bin histogram with running mean and variance of the values.
+
+    Values outside of [bin_min, bin_max] are counted as underflow/overflow,
+    NaN values (invalid tuples) are skipped. Accumulators of different
+    processes are combined with merge().
+    """
+
+    def __init__(self, bin_min, bin_max, bins):
+        self.edges = numpy.linspace(bin_min, bin_max, bins + 1)
+        self.histogram = numpy.zeros(bins, dtype=numpy.int64)
+        self.underflow = 0
+        self.overflow = 0
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def _add_moments(self, n, mean, m2):
+        """Combines the moments with the moments of another set of values (Chan et al.)."""
+        total = self.n + n
+        delta = mean - self.mean
+        self.mean += delta * n / float(total)
+        self.m2 += m2 + delta**2 * self.n * n / float(total)
+        self.n = total
+
+    def add(self, values):
+        """Adds the array of values."""
+        values = numpy.asarray(values, dtype=numpy.double).ravel()
+        values = values[~numpy.isnan(values)]
+        if len(values) == 0:
+            return
+        bins = len(self.histogram)
+        width = self.edges[1] - self.edges[0]
+        idx = numpy.floor((values - self.edges[0]) / width).astype(numpy.int64)
+        idx[values == self.edges[-1]] = bins - 1
+        self.underflow += int(numpy.count_nonzero(idx < 0))
+        self.overflow += int(numpy.count_nonzero(idx >= bins))
+        inside = (idx >= 0) & (idx < bins)
+        self.histogram += numpy.bincount(idx[inside], minlength=bins)
+        mean = values.mean()
+        self._add_moments(len(values), mean, ((values - mean)**2).sum())
+
+    def merge(self, other):
+        """Adds the accumulator with the same bins."""
+        if not numpy.allclose(self.edges, other.edges):
+            raise RuntimeError('Can not merge histograms with different bins')
+        self.histogram += other.histogram
+        self.underflow += other.underflow
+        self.overflow += other.overflow
+        if other.n > 0:
+            self._add_moments(other.n, other.mean, other.m2)
+
+    @property
+    def var(self):
+        return self.m2 / (self.n - 1) if self.n > 1 else 0.0
+
+    @property
+    def std(self):
+        return numpy.sqrt(self.var)
+
+    def save(self, file_name, header=''):
+        """Saves bin centres, counts and probability density, statistics in the header.
+
+        Args:
+            file_name: The output file.
+            header: The comment lines (with #) put before the statistics.
+        """
+        width = self.edges[1] - self.edges[0]
+        centers = 0.5*(self.edges[1:] + self.edges[:-1])
+        n_inside = self.histogram.sum()
+        density = self.histogram / (float(n_inside) * width) if n_inside else numpy.zeros_like(centers)
+        stats = ('# samples: {} underflow: {} overflow: {}\n'
+                 '# avg: {} var: {} std: {}\n'
+                 '# bin_center count density').format(
+            self.n, self.underflow, self.overflow, self.mean, self.var, self.std)
+        numpy.savetxt(file_name, numpy.column_stack((centers, self.histogram, density)),
+                      header=header + stats, comments='')
@@ -16,6 +16,9 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 import sys
 import numpy as np
 cimport numpy as np
+from libc.math cimport sqrt, floor, acos, atan2, NAN
+
+cdef double RAD2DEG = 180.0 / 3.141592653589793
 
 cpdef inline double calc_distance_sqr(np.ndarray pos_1, np.ndarray pos_2, np.ndarray box, np.ndarray half_box):
     cdef np.ndarray d = pos_1 - pos_2
@@ -148,6 +151,127 @@ cpdef list calculate_dihedral(np.ndarray atom_quadruples, np.ndarray box, np.nda
     return dihedrals
 
 
+cdef inline double _min_image(double d, double L) nogil:
+    if L > 0.0:
+        return d - L*floor(d/L + 0.5)
+    return d
+
+
+cdef inline double _dot(double *a, double *b) nogil:
+    return a[0]*b[0] + a[1]*b[1] + a[2]*b[2]
+
+
+cdef _bonded_kernel(double[:, :, ::1] traj, int[:, ::1] indices, double[::1] box,
+                    unsigned char[:, ::1] valid, bint use_mask, int kind, double[:, :, ::1] output):
+    """Computes bond vectors (kind 0), distances (1), angles (2) or dihedrals (3).
+
+    b[v] = p[v] - p[v+1] with minimum image, p are the atoms of the tuple.
+    """
+    cdef int T = traj.shape[0]
+    cdef int M = indices.shape[0]
+    cdef int n_vec = indices.shape[1] - 1
+    cdef int t, m, v, k
+    cdef double b[3][3]
+    cdef double w0[3]
+    cdef double w2[3]
+    cdef double b1n[3]
+    cdef double cross[3]
+    cdef double c, n0, n2, n1
+
+    with nogil:
+        for t in range(T):
+            for m in range(M):
+                if use_mask and not valid[t, m]:
+                    for k in range(output.shape[2]):
+                        output[t, m, k] = NAN
+                    continue
+                for v in range(n_vec):
+                    for k in range(3):
+                        b[v][k] = _min_image(
+                            traj[t, indices[m, v], k] - traj[t, indices[m, v+1], k], box[k])
+                if kind == 0:
+                    for k in range(3):
+                        output[t, m, k] = -b[0][k]
+                elif kind == 1:
+                    output[t, m, 0] = sqrt(_dot(b[0], b[0]))
+                elif kind == 2:
+                    # angle between p0 - p1 and p2 - p1
+                    c = -_dot(b[0], b[1]) / sqrt(_dot(b[0], b[0]) * _dot(b[1], b[1]))
+                    c = min(1.0, max(-1.0, c))
+                    output[t, m, 0] = acos(c) * RAD2DEG
+                else:
+                    # the same convention as calculate_dihedral, b0 = p1 - p0
+                    for k in range(3):
+                        b[0][k] = -b[0][k]
+                    n1 = _dot(b[1], b[1])
+                    c = _dot(b[0], b[1]) / n1
+                    for k in range(3):
+                        w0[k] = b[0][k] - c*b[1][k]
+                    c = _dot(b[2], b[1]) / n1
+                    for k in range(3):
+                        w2[k] = b[2][k] - c*b[1][k]
+                    n0 = sqrt(_dot(w0, w0))
+                    n2 = sqrt(_dot(w2, w2))
+                    n1 = sqrt(n1)
+                    for k in range(3):
+                        w0[k] /= n0
+                        w2[k] /= n2
+                        b1n[k] = b[1][k] / n1
+                    cross[0] = w0[1]*b1n[2] - w0[2]*b1n[1]
+                    cross[1] = w0[2]*b1n[0] - w0[0]*b1n[2]
+                    cross[2] = w0[0]*b1n[1] - w0[1]*b1n[0]
+                    output[t, m, 0] = atan2(_dot(cross, w2), _dot(w0, w2)) * RAD2DEG
+
+
+def _bonded_array(traj, indices, box, valid, int kind, int tuple_size):
+    traj = np.asarray(traj, dtype=np.double)
+    if traj.ndim == 2:
+        traj = traj[np.newaxis]
+    traj = np.ascontiguousarray(traj)
+    indices = np.ascontiguousarray(indices, dtype=np.int32).reshape(-1, tuple_size)
+    if indices.size and (indices.min() < 0 or indices.max() >= traj.shape[1]):
+        raise ValueError('Atom index out of range')
+    box = np.ascontiguousarray(box, dtype=np.double).reshape(3)
+    use_mask = valid is not None
+    if use_mask:
+        valid = np.ascontiguousarray(np.broadcast_to(valid, (traj.shape[0], len(indices))), dtype=np.uint8)
+    else:
+        valid = np.zeros((0, 0), dtype=np.uint8)
+    output = np.zeros((traj.shape[0], len(indices), 3 if kind == 0 else 1))
+    _bonded_kernel(traj, indices, box, valid, use_mask, kind, output)
+    return output if kind == 0 else output[:, :, 0]
+
+
+def calculate_bond_vec_array(traj, indices, box, valid=None):
+    """Calculates bond vectors p1 - p0 with minimum image.
+
+    Args:
+        traj: The (T, N, 3) array (or single (N, 3) frame) with positions.
+        indices: The (M, 2) array with atom indices.
+        box: The box size.
+        valid: The optional (T, M) boolean mask, invalid tuples give NaN.
+
+    Returns:
+        The (T, M, 3) array.
+    """
+    return _bonded_array(traj, indices, box, valid, 0, 2)
+
+
+def calculate_bond_array(traj, indices, box, valid=None):
+    """Calculates bond distances, see calculate_bond_vec_array. Returns (T, M) array."""
+    return _bonded_array(traj, indices, box, valid, 1, 2)
+
+
+def calculate_angle_array(traj, indices, box, valid=None):
+    """Calculates angles (in degrees) for (M, 3) indices, see calculate_bond_vec_array. Returns (T, M) array."""
+    return _bonded_array(traj, indices, box, valid, 2, 3)
+
+
+def calculate_dihedral_array(traj, indices, box, valid=None):
+    """Calculates dihedrals (in degrees) for (M, 4) indices, see calculate_bond_vec_array. Returns (T, M) array."""
+    return _bonded_array(traj, indices, box, valid, 3, 4)
+
+
 cpdef process_distance(np.ndarray atom_pairs, np.ndarray box, np.ndarray half_box):
     bonds = []
     cdef int l = len(atom_pairs)
@@ -236,25 +360,54 @@ cpdef list calculate_msd_internal_distance(np.ndarray frame, int nchains, int ch
     Returns:
         The data set indexed by n.
     """
-    cdef np.ndarray output = np.zeros(chain_length)
-    cdef np.ndarray error = np.zeros(chain_length)
-    cdef int n, j, t, i
-    cdef int m
-    cdef double sumsqdist = 0.0
-    cdef double intdist_sum = 0.0
-    cdef np.ndarray d = np.zeros(3)
-    cdef list intermediate_results = [[] for _ in range(chain_length)]
-
-    for n in xrange(0, chain_length):
-        intdist_sum = 0.0
-        for j in xrange(nchains):
+    return [[v] for v in calculate_internal_distance(frame, nchains, chain_length)[0]]
+
+
+cdef _internal_distance(double[:, ::1] frame, int nchains, int chain_length, double[::1] output):
+    cdef int n, j, i
+    cdef double dx, dy, dz, sumsqdist
+    with nogil:
+        for n in range(1, chain_length):
             sumsqdist = 0.0
-            for i in xrange(j*chain_length, j*chain_length + chain_length - n):
-                d = frame[i+n] - frame[i]
-                sumsqdist += d.dot(d)
-            intdist_sum += sumsqdist  / (chain_length - n)
-        intermediate_results[n].append(intdist_sum/nchains)
-    return intermediate_results
+            for j in range(nchains):
+                for i in range(j*chain_length, j*chain_length + chain_length - n):
+                    dx = frame[i+n, 0] - frame[i, 0]
+                    dy = frame[i+n, 1] - frame[i, 1]
+                    dz = frame[i+n, 2] - frame[i, 2]
+                    sumsqdist += dx*dx + dy*dy + dz*dz
+            output[n] = sumsqdist / ((chain_length - n) * nchains)
+
+
+cpdef np.ndarray calculate_internal_distance(np.ndarray traj, int nchains, int chain_length,
+                                             int max_strided_length=100):
+    """Calculates mean square internal distance <R^2(n)> for all separations n.
+
+    Short chains are computed with strided differences of the (T, chains, chain_length, 3)
+    view, long chains with the compiled loop (no temporary arrays).
+
+    Args:
+        traj: The (N, 3) frame or (T, N, 3) block of frames with unwrapped positions.
+        nchains: Number of polymer chains (the first nchains*chain_length particles).
+        chain_length: Length of polymer chain.
+        max_strided_length: The longest chain computed with strided differences.
+    Returns:
+        The (T, chain_length) array, <R^2(n)> averaged over beads and chains of every frame.
+    """
+    cdef int t
+    traj = np.asarray(traj, dtype=np.double)
+    if traj.ndim == 2:
+        traj = traj[np.newaxis]
+    traj = traj[:, :nchains*chain_length]
+    cdef np.ndarray output = np.zeros((traj.shape[0], chain_length))
+    if chain_length <= max_strided_length:
+        r = traj.reshape(traj.shape[0], nchains, chain_length, 3)
+        for n in range(1, chain_length):
+            d = r[:, :, n:] - r[:, :, :-n]
+            output[:, n] = np.einsum('tcik,tcik->t', d, d) / ((chain_length - n) * nchains)
+    else:
+        for t in range(traj.shape[0]):
+            _internal_distance(np.ascontiguousarray(traj[t]), nchains, chain_length, output[t])
+    return output
 
 
 cpdef tuple calculate_com_chains(np.ndarray traj, int chain_length, int chains, np.ndarray masses, double tot_mass):
@@ -283,6 +436,51 @@ cpdef tuple calculate_com_chains(np.ndarray traj, int chain_length, int chains,
     return output, output_sys
 
 
+cpdef tuple calculate_com_chains_batch(np.ndarray traj, np.ndarray masses, int chain_length=0, int chains=0,
+                                       np.ndarray offsets=None):
+    """Calculates COM of chains for a block of frames.
+
+    Chains are either of the same length (chain_length, chains) or defined by
+    CSR-style offsets, chain i has particles offsets[i]:offsets[i+1].
+
+    Args:
+        traj: The (T, N, 3) array with unwrapped positions.
+        masses: The numpy array with masses of N particles (or of chain_length particles).
+        chain_length: The length of chains.
+        chains: The number of chains, default N // chain_length.
+        offsets: The array with chains+1 offsets for chains of different length.
+    Returns:
+        The tuple with (T, chains, 3) center of mass of chains and (T, 3)
+        center of mass of the system (of all particles in chains).
+    """
+    cdef np.ndarray com, chain_masses, weighted
+    traj = np.asarray(traj, dtype=np.double)
+    masses = np.asarray(masses, dtype=np.double)
+    if offsets is None:
+        if chain_length < 1:
+            raise ValueError('chain_length or offsets required')
+        if chains < 1:
+            chains = traj.shape[1] // chain_length
+        if len(masses) != chain_length:
+            masses = masses[:chains*chain_length].reshape(chains, chain_length)
+        else:
+            masses = np.tile(masses, (chains, 1))
+        chain_masses = masses.sum(axis=1)
+        com = np.einsum('tcnk,cn->tck', traj[:, :chains*chain_length].reshape(
+            traj.shape[0], chains, chain_length, 3), masses)
+    else:
+        offsets = np.asarray(offsets, dtype=np.int64)
+        if np.any(np.diff(offsets) < 1):
+            raise ValueError('Empty chain in offsets')
+        masses = masses[:offsets[-1]]
+        chain_masses = np.add.reduceat(masses, offsets[:-1])
+        weighted = traj[:, offsets[0]:offsets[-1]] * masses[offsets[0]:, np.newaxis]
+        com = np.add.reduceat(weighted, offsets[:-1] - offsets[0], axis=1)
+    sys_com = com.sum(axis=1) / chain_masses.sum()
+    com /= chain_masses[np.newaxis, :, np.newaxis]
+    return com, sys_com
+
+
 cpdef tuple calculate_msd_single(
         np.ndarray trj_com,
         np.ndarray trj_sys_com,
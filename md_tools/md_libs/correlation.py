@@ -0,0 +1,333 @@
+"""
+Copyright (C) 2017 Jakub Krajniak <jkrajniak@gmail.com>
+
+This file is part of lab-tools.
+
+lab-tools is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import itertools
+import math
+import numpy
+
+__doc__ = "Time correlation functions (MSD, ACF) computed with FFT or multiple-tau correlator."
+
+
+def _fft_size(T):
+    """Returns the power of two >= 2*T, zero padding avoids the circular wrap."""
+    n = 1
+    while n < 2*T:
+        n *= 2
+    return n
+
+
+def _correlate(a, b, n_fft, max_tau):
+    """Returns c(m) = sum_n a(n)*b(n+m) along the first axis for m = 0..max_tau."""
+    fa = numpy.fft.rfft(a, n=n_fft, axis=0)
+    fb = numpy.fft.rfft(b, n=n_fft, axis=0)
+    return numpy.fft.irfft(fa.conj()*fb, n=n_fft, axis=0)[:max_tau+1]
+
+
+def _msd_batch(r, v, origins, n_fft, max_tau):
+    """Returns the sum of squared displacements and the number of origins, (max_tau+1, n) arrays."""
+    r = r*v[:, :, numpy.newaxis]
+    d = numpy.einsum('tij,tij->ti', r, r)
+    w = origins[:, numpy.newaxis]*v
+
+    # sum over origins n of v(n)*v(n+m)*[r(n)^2 + r(n+m)^2 - 2 r(n).r(n+m)]
+    count = numpy.rint(_correlate(w, v, n_fft, max_tau))
+    sd = _correlate(w*d, v, n_fft, max_tau) + _correlate(w, d, n_fft, max_tau)
+    sd -= 2.0*_correlate(w[:, :, numpy.newaxis]*r, r, n_fft, max_tau).sum(axis=2)
+    return sd, count
+
+
+def _msd_batches(trj, valid, r_every, max_tau, batch_size):
+    """Yields per-particle (sd, count) for batches of particles."""
+    T, N = trj.shape[0], trj.shape[1]
+    n_fft = _fft_size(T)
+    origins = numpy.zeros(T)
+    origins[::r_every] = 1.0
+    for i0 in range(0, N, batch_size):
+        r = numpy.asarray(trj[:, i0:i0+batch_size], dtype=numpy.double)
+        if valid is None:
+            v = numpy.ones(r.shape[:2])
+        else:
+            v = numpy.asarray(valid[:, i0:i0+batch_size], dtype=numpy.double)
+        yield _msd_batch(r, v, origins, n_fft, max_tau)
+
+
+def _max_tau(T, max_tau):
+    if max_tau is None or max_tau > T - 1 or max_tau < 0:
+        max_tau = T - 1
+    return int(max_tau)
+
+
+def msd_fft(trj, valid=None, r_every=1, max_tau=None, batch_size=1000):
+    """Calculates MSD for all lags with FFT.
+
+    Uses the decomposition MSD(m) = S1(m) - 2*S2(m) where S2 is the position
+    autocorrelation. All sums are correlations along time, so every lag costs
+    O(T log T) per particle.
+
+    Args:
+        trj: The (T, N, 3) array with unwrapped positions.
+        valid: The optional (T, N) boolean mask, only pairs of frames where
+            the particle is valid at both ends are counted.
+        r_every: Use time origins every r_every frame.
+        max_tau: The maximum lag (in frames), default T-1.
+        batch_size: The number of particles transformed at once.
+
+    Returns:
+        The tuple with MSD and its standard deviation over particles, both of length max_tau+1.
+    """
+    max_tau = _max_tau(trj.shape[0], max_tau)
+
+    sum_sd = numpy.zeros(max_tau+1)
+    sum_count = numpy.zeros(max_tau+1)
+    sum_msd = numpy.zeros(max_tau+1)
+    sum_msd_sqr = numpy.zeros(max_tau+1)
+    num_particles = numpy.zeros(max_tau+1)
+
+    for sd, count in _msd_batches(trj, valid, r_every, max_tau, batch_size):
+        has_data = count > 0
+        msd_i = numpy.where(has_data, sd/numpy.where(has_data, count, 1.0), 0.0)
+        sum_sd += sd.sum(axis=1)
+        sum_count += count.sum(axis=1)
+        sum_msd += msd_i.sum(axis=1)
+        sum_msd_sqr += (msd_i**2).sum(axis=1)
+        num_particles += has_data.sum(axis=1)
+
+    msd = sum_sd/sum_count
+    mean_msd = sum_msd/num_particles
+    msd_var = (sum_msd_sqr - num_particles*mean_msd**2)/numpy.maximum(num_particles - 1, 1)
+    return msd, numpy.sqrt(numpy.maximum(msd_var, 0.0))
+
+
+def msd_fft_particles(trj, valid=None, r_every=1, max_tau=None, batch_size=1000):
+    """Calculates MSD of every particle (molecule) for all lags with FFT.
+
+    Args: see msd_fft.
+
+    Returns:
+        The (max_tau+1, N) array with MSD of particles, NaN where there is no time origin.
+    """
+    max_tau = _max_tau(trj.shape[0], max_tau)
+    output = []
+    for sd, count in _msd_batches(trj, valid, r_every, max_tau, batch_size):
+        output.append(numpy.where(count > 0, sd/numpy.where(count > 0, count, 1.0), numpy.nan))
+    return numpy.concatenate(output, axis=1)
+
+
+def fit_diffusion(time, msd, begin_fit=None, end_fit=None, dim=3):
+    """Fits diffusion coefficients MSD(t) = 2*dim*D*t + b for many MSD curves at once.
+
+    Like gmx msd, the fit window defaults to 10%-90% of the time range and
+    the error is the difference of D fitted on the two halves of the window.
+
+    Args:
+        time: The array with lag times.
+        msd: The (len(time), N) array with MSD curves.
+        begin_fit, end_fit: The fit window (in time units).
+        dim: The dimensionality.
+
+    Returns:
+        The tuple with arrays of D and its error, in units of msd/time.
+    """
+    time = numpy.asarray(time, dtype=numpy.double)
+    msd = numpy.asarray(msd, dtype=numpy.double)
+    if msd.ndim == 1:
+        msd = msd[:, numpy.newaxis]
+    if begin_fit is None or begin_fit < 0:
+        begin_fit = time[0] + 0.1*(time[-1] - time[0])
+    if end_fit is None or end_fit < 0:
+        end_fit = time[0] + 0.9*(time[-1] - time[0])
+
+    def slope(t_min, t_max):
+        window = (time >= t_min) & (time <= t_max)
+        t = time[window]
+        y = msd[window]
+        dt = t - t.mean()
+        return numpy.einsum('t,tn->n', dt, y - y.mean(axis=0)) / numpy.dot(dt, dt)
+
+    D = slope(begin_fit, end_fit) / (2.0*dim)
+    mid_fit = 0.5*(begin_fit + end_fit)
+    D_error = numpy.abs(slope(begin_fit, mid_fit) - slope(mid_fit, end_fit)) / (2.0*dim)
+    return D, D_error
+
+
+def _sum_dot_power(u, k, n_fft, max_tau):
+    """Returns sum over origins n and molecules i of (u_i(n).u_i(n+m))^k for m = 0..max_tau.
+
+    The power of the dot product is expanded into products of the components
+    of the symmetric tensor u^k, every component is a correlation along time.
+    """
+    result = numpy.zeros(max_tau+1)
+    dim = u.shape[2]
+    for idx in itertools.combinations_with_replacement(range(dim), k):
+        counts = numpy.bincount(idx, minlength=dim)
+        weight = math.factorial(k) / numpy.prod([math.factorial(c) for c in counts])
+        a = numpy.prod(u[:, :, list(idx)], axis=2)
+        fa = numpy.fft.rfft(a, n=n_fft, axis=0)
+        result += weight * numpy.fft.irfft((fa.conj()*fa).sum(axis=1), n=n_fft)[:max_tau+1]
+    return result
+
+
+def acf_fft(vectors, max_tau=None, legendre=1, batch_size=1000):
+    """Calculates autocorrelation function of vectors with FFT.
+
+    C(m) = <P_l(u_i(n).u_i(n+m))> averaged over origins n and molecules i,
+    where P_1(x) = x and P_2(x) = (3x^2 - 1)/2.
+
+    Args:
+        vectors: The (T, M, 3) array with vectors (unit vectors for legendre=2).
+        max_tau: The maximum lag (in frames), default T-1.
+        legendre: The order of Legendre polynomial, 1 or 2.
+        batch_size: The number of molecules transformed at once.
+
+    Returns:
+        The tuple with C and its standard deviation over origins and molecules,
+        both of length max_tau+1.
+    """
+    if legendre not in (1, 2):
+        raise ValueError('Legendre polynomial of order {} not supported'.format(legendre))
+    T, M = vectors.shape[0], vectors.shape[1]
+    max_tau = _max_tau(T, max_tau)
+    n_fft = _fft_size(T)
+
+    # sums of x^k, x = u(n).u(n+m)
+    sums = numpy.zeros((2*legendre + 1, max_tau+1))
+    for i0 in range(0, M, batch_size):
+        u = numpy.asarray(vectors[:, i0:i0+batch_size], dtype=numpy.double)
+        for k in range(1, 2*legendre + 1):
+            sums[k] += _sum_dot_power(u, k, n_fft, max_tau)
+    count = (T - numpy.arange(max_tau+1)) * float(M)
+    moments = sums / count
+
+    if legendre == 1:
+        acf = moments[1]
+        var = moments[2] - moments[1]**2
+    else:
+        acf = 1.5*moments[2] - 0.5
+        var = 2.25*(moments[4] - moments[2]**2)
+    var *= count / numpy.maximum(count - 1, 1)
+    return acf, numpy.sqrt(numpy.maximum(var, 0.0))
+
+
+class MultipleTauCorrelator(object):
+    """Multiple-tau (blocking) correlator.
+
+    Frames are added one by one. Level 0 keeps the last p values and gives
+    lags 0..p-1, every next level gets the values coarse-grained by factor m
+    and gives lags j*m^k for j = p/m..p-1. The memory is O(levels*p) per
+    particle and the lags are quasi-logarithmically spaced, so the lag up to
+    the full trajectory length is cheap.
+
+    Args:
+        p: The number of values kept at each level.
+        m: The coarse-graining factor between levels, p has to be divisible by m.
+        mode: 'msd' for <|x(t+tau) - x(t)|^2> or 'acf' for <x(t).x(t+tau)>,
+            averaged over particles.
+        average: Coarse-grain by averaging m values (default for acf) or by
+            taking every m-th value (default for msd; exact MSD with less time origins).
+        levels: The maximum number of levels, default unlimited.
+    """
+
+    def __init__(self, p=16, m=2, mode='msd', average=None, levels=None):
+        if p % m != 0:
+            raise ValueError('p={} has to be divisible by m={}'.format(p, m))
+        if mode not in ('msd', 'acf'):
+            raise ValueError('Unknown mode {}'.format(mode))
+        self.p = p
+        self.m = m
+        self.mode = mode
+        self.average = mode == 'acf' if average is None else average
+        self.levels = levels
+        self.n_frames = 0
+
+        self._buffer = []
+        self._head = []
+        self._filled = []
+        self._acc = []
+        self._acc_n = []
+        self._sum = []
+        self._sum_sqr = []
+        self._count = []
+
+    def add(self, x):
+        """Adds a new frame, x is (N, dim) array (or (N,) for scalars)."""
+        x = numpy.array(x, dtype=numpy.double)
+        if x.ndim == 1:
+            x = x[:, numpy.newaxis]
+        self._add(0, x)
+        self.n_frames += 1
+
+    def _add_level(self, shape):
+        self._buffer.append(numpy.zeros((self.p,) + shape))
+        self._head.append(-1)
+        self._filled.append(0)
+        self._acc.append(numpy.zeros(shape))
+        self._acc_n.append(0)
+        self._sum.append(numpy.zeros(self.p))
+        self._sum_sqr.append(numpy.zeros(self.p))
+        self._count.append(numpy.zeros(self.p, dtype=numpy.int64))
+
+    def _add(self, k, x):
+        if k == len(self._buffer):
+            if self.levels is not None and k >= self.levels:
+                return
+            self._add_level(x.shape)
+        p = self.p
+        self._head[k] = (self._head[k] + 1) % p
+        self._buffer[k][self._head[k]] = x
+        self._filled[k] = min(self._filled[k] + 1, p)
+
+        # Lags below p/m are already covered by the previous level.
+        j_min = 0 if k == 0 else p // self.m
+        if self._filled[k] > j_min:
+            lags = numpy.arange(j_min, self._filled[k])
+            old = self._buffer[k][(self._head[k] - lags) % p]
+            if self.mode == 'msd':
+                d = old - x
+                values = numpy.einsum('jid,jid->ji', d, d).mean(axis=1)
+            else:
+                values = numpy.einsum('jid,id->ji', old, x).mean(axis=1)
+            self._sum[k][lags] += values
+            self._sum_sqr[k][lags] += values**2
+            self._count[k][lags] += 1
+
+        if self.average:
+            self._acc[k] += x
+        self._acc_n[k] += 1
+        if self._acc_n[k] == self.m:
+            value = self._acc[k] / self.m if self.average else x
+            self._acc[k] = numpy.zeros_like(x)
+            self._acc_n[k] = 0
+            self._add(k + 1, value)
+
+    def result(self):
+        """Returns the lags (in frames), the mean, its standard deviation over time origins and the number of origins."""
+        lags, mean, std, count = [], [], [], []
+        for k in range(len(self._buffer)):
+            j_min = 0 if k == 0 else self.p // self.m
+            for j in range(j_min, self.p):
+                n = self._count[k][j]
+                if n == 0:
+                    continue
+                avg = self._sum[k][j] / n
+                var = (self._sum_sqr[k][j] - n*avg**2) / max(n - 1, 1)
+                lags.append(j * self.m**k)
+                mean.append(avg)
+                std.append(numpy.sqrt(max(var, 0.0)))
+                count.append(n)
+        return numpy.array(lags), numpy.array(mean), numpy.array(std), numpy.array(count)
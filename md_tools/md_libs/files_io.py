@@ -24,7 +24,6 @@ import logging
 import numpy
 import os
 import re
-import sys
 import warnings
 
 try:
@@ -105,28 +104,106 @@ def prepare_path(file_path):
     return file_path
 
 
-def sort_h5md_array(input_array, ids, max_T=None):
-    """Sorts H5MD dataset"""
+def sort_permutation(ids):
+    """Returns (T, N) permutations of columns that sort particle ids in every frame.
 
+    The padding ids (-1) are moved to the end, frames with already sorted ids
+    get the identity permutation. Frames where ids form a contiguous range
+    (the usual case) are inverted in O(N) by scattering, the rest is argsorted.
+    """
+    ids = numpy.asarray(ids)
+    if ids.ndim == 1:
+        ids = ids[numpy.newaxis]
+    N = ids.shape[1]
+    pad = numpy.iinfo(ids.dtype).max if ids.dtype.kind in 'iu' else numpy.inf
+    key = numpy.where(ids == -1, pad, ids)
+    permutation = numpy.empty(key.shape, dtype=numpy.intp)
+    permutation[:] = numpy.arange(N)
+    rows = numpy.where(numpy.any(key[:, 1:] < key[:, :-1], axis=1))[0]
+    if len(rows) == 0:
+        return permutation
+
+    # Contiguous ids: the rank of the column is id - min(id), padding keeps its order at the end.
+    valid = ids[rows] != -1
+    n_valid = valid.sum(axis=1)
+    low = numpy.where(valid, key[rows], pad).min(axis=1)
+    high = numpy.where(valid, key[rows], low[:, numpy.newaxis]).max(axis=1)
+    dense = high - low + 1 == n_valid
+    if dense.any():
+        d_valid = valid[dense]
+        rank = key[rows[dense]] - low[dense, numpy.newaxis]
+        if not d_valid.all():
+            rank = numpy.where(d_valid, rank, n_valid[dense, numpy.newaxis] + numpy.cumsum(~d_valid, axis=1) - 1)
+        rank = rank.astype(numpy.intp)
+        d_perm = numpy.full(rank.shape, -1, dtype=numpy.intp)
+        d_perm[numpy.arange(len(rank))[:, numpy.newaxis], rank] = numpy.arange(N)
+        # Duplicated ids leave holes, such frames are argsorted.
+        complete = ~numpy.any(d_perm == -1, axis=1)
+        permutation[rows[dense][complete]] = d_perm[complete]
+        dense[numpy.where(dense)[0][~complete]] = False
+    if not dense.all():
+        permutation[rows[~dense]] = numpy.argsort(key[rows[~dense]], axis=1, kind='mergesort')
+    return permutation
+
+
+def sort_h5md_array(input_array, ids, max_T=None, permutation=None):
+    """Sorts H5MD dataset
+
+    Args:
+      input_array: The (T, N, ...) array (or h5py dataset) with particle columns.
+      ids: The (T, N) particle ids, -1 for the empty columns.
+      max_T: Sorts only max_T first frames.
+      permutation: The result of sort_permutation(ids), can be reused for
+        all datasets with the same id time grid.
+
+    Returns:
+      The sorted array.
+    """
     T = len(input_array)
-    output_shape = list(input_array.shape)
     if max_T:
         T = max_T
-        output_shape[0] = T
-    output_array = numpy.zeros(output_shape)
-    # Iterates over time frames.
-    for t in range(T):
-        sys.stdout.write('Progress: {:.2f} %\r'.format(100.0 * float(t) / T))
-        sys.stdout.flush()
-        idd = [
-            x[1] for x in sorted(
-                [(p_id, col_id) for col_id, p_id in enumerate(ids[t])],
-                key=lambda y: (True, y[0]) if y[0] == -1 else (False, y[0]))
-            ]
-        output_array[t] = input_array[t][idd]
+    input_array = numpy.asarray(input_array[:T])
+    if permutation is None:
+        permutation = sort_permutation(ids[:T])
+    permutation = permutation[:T]
+    permutation = permutation.reshape(permutation.shape + (1,)*(input_array.ndim - 2))
+    unsorted = numpy.any(permutation.reshape(T, -1) != numpy.arange(permutation.shape[1]), axis=1)
+    if unsorted.all():
+        return numpy.take_along_axis(input_array, permutation, axis=1)
+    output_array = input_array.copy()
+    if unsorted.any():
+        output_array[unsorted] = numpy.take_along_axis(input_array[unsorted], permutation[unsorted], axis=1)
     return output_array
 
 
+def chunk_aligned_blocks(dataset, begin=0, end=-1, block_size=None):
+    """Splits the frame range of dataset into blocks that follow HDF5 chunks.
+
+    Args:
+      dataset: The h5py dataset with time as the first axis.
+      begin: The first frame.
+      end: The last frame (right open), -1 means the end of the dataset.
+      block_size: Requested number of frames in the block, rounded to
+        the multiple of chunk size along the time axis.
+
+    Returns:
+      The list of (start, stop) tuples.
+    """
+    if end == -1 or end is None:
+        end = dataset.shape[0]
+    chunk_t = dataset.chunks[0] if dataset.chunks else 1
+    if block_size is None:
+        block_size = chunk_t
+    step = chunk_t * max(1, int(block_size) // chunk_t)
+    blocks = []
+    start = begin
+    while start < end:
+        stop = min(end, (start // step + 1) * step)
+        blocks.append((start, stop))
+        start = stop
+    return blocks
+
+
 def prepare_h5md(h5file, group_name, begin, end, step=None, no_image=False, sort_h5md=True):
     """Returns H5MD data that are sorted and transformed."""
 
@@ -138,6 +215,7 @@ def prepare_h5md(h5file, group_name, begin, end, step=None, no_image=False, sort
     if 'id' in list(h5file['/particles/{}/'.format(group_name)].keys()):
         print('Found id/ group, columns will be sorted.')
         ids = h5file['/particles/{}/id/value'.format(group_name)][begin:end:step]
+        permutation = sort_permutation(ids)
 
     # Prepares box. Assumes that box is static even if there are time-dependent values.
     box = h5file['/particles/{}/box/edges'.format(group_name)]
@@ -151,7 +229,7 @@ def prepare_h5md(h5file, group_name, begin, end, step=None, no_image=False, sort
         h5file['/particles/{}/position/value'.format(group_name)][begin:end:step]
     )
     if ids is not None and sort_h5md:
-        trj = sort_h5md_array(trj, ids)
+        trj = sort_h5md_array(trj, ids, permutation=permutation)
 
     if 'image' in list(h5file['/particles/{}'.format(group_name)].keys()) and not no_image:
         print('Found image group, computing absolute trajectory...')
@@ -159,7 +237,7 @@ def prepare_h5md(h5file, group_name, begin, end, step=None, no_image=False, sort
             h5file['/particles/{}/image/value'.format(group_name)][begin:end:step]
         )
         if ids is not None and sort_h5md:
-            image = sort_h5md_array(image, ids)
+            image = sort_h5md_array(image, ids, permutation=permutation)
         trj = trj + box * image
 
     # Prepares masses.
@@ -167,7 +245,7 @@ def prepare_h5md(h5file, group_name, begin, end, step=None, no_image=False, sort
     if 'value' in masses:
         masses = masses['value']
         if ids is not None and sort_h5md:
-            masses = sort_h5md_array(masses, ids, 1)
+            masses = sort_h5md_array(masses, ids, 1, permutation=permutation)
         masses = masses[0]
     masses = numpy.array(masses)
     return ids, box, trj, masses
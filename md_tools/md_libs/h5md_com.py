@@ -0,0 +1,228 @@
+"""
+Copyright (C) 2017 Jakub Krajniak <jkrajniak@gmail.com>
+
+This file is part of lab-tools.
+
+lab-tools is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import hashlib
+import json
+import numpy
+import sys
+
+from md_libs import bonds
+from md_libs import h5md_trajectory
+
+__doc__ = """Molecule COM trajectory stored in the H5MD file as /particles/<group>_com.
+
+The COM group has the H5MD layout: position/{value,step,time}, id/{value,step,time}
+(molecule ids, same in every frame), box and mass (molecule masses). The attribute
+'provenance' (JSON) keeps the source group, the source hash, the hashes of the molecule
+definition and of the masses, the mass source and the frame range."""
+
+
+def com_group_name(group_name):
+    return '{}_com'.format(group_name)
+
+
+def source_hash(h5file, group_name):
+    """Returns the hash of the source trajectory.
+
+    Only the shape, the time dataset and the first and the last frame are hashed,
+    reading the full trajectory would cost as much as computing COMs.
+    """
+    position = h5file['/particles/{}/position'.format(group_name)]
+    h = hashlib.sha1()
+    h.update(str(position['value'].shape).encode())
+    h.update(numpy.ascontiguousarray(position['time'][()]).tobytes())
+    if position['value'].shape[0] > 0:
+        h.update(numpy.ascontiguousarray(position['value'][0]).tobytes())
+        h.update(numpy.ascontiguousarray(position['value'][-1]).tobytes())
+    return h.hexdigest()
+
+
+def molecules_hash(order, offsets):
+    """Returns the hash of the molecule definition (columns of every molecule)."""
+    h = hashlib.sha1()
+    h.update(numpy.ascontiguousarray(order, dtype=numpy.int64).tobytes())
+    h.update(numpy.ascontiguousarray(offsets, dtype=numpy.int64).tobytes())
+    return h.hexdigest()
+
+
+def masses_hash(masses):
+    return hashlib.sha1(numpy.ascontiguousarray(masses, dtype=numpy.double).tobytes()).hexdigest()
+
+
+def sorted_pids(h5file, group_name, frame=0):
+    """Returns particle ids of the columns after sorting with files_io.sort_h5md_array."""
+    group = h5file['/particles/{}'.format(group_name)]
+    if 'id' not in group:
+        return numpy.arange(1, group['position/value'].shape[1] + 1)
+    ids = numpy.array(group['id/value'][frame])
+    return numpy.sort(ids[ids != -1])
+
+
+def molecules_from_chains(chain_length, chains):
+    """Returns (order, offsets, mol_ids) for consecutive chains of the same length."""
+    order = numpy.arange(chain_length*chains)
+    offsets = numpy.arange(0, chain_length*chains + 1, chain_length)
+    return order, offsets, numpy.arange(1, chains + 1)
+
+
+def molecules_from_topology(top, pids):
+    """Returns molecule definition and masses from the GROMACS topology.
+
+    Args:
+        top: The GROMACSTopologyFile object.
+        pids: The particle ids of columns of the sorted trajectory.
+
+    Returns:
+        The tuple with order (columns grouped by molecule), CSR offsets,
+        molecule ids (chain_idx) and masses of columns.
+    """
+    chain_idx = numpy.array([top.atoms[p].chain_idx if p in top.atoms else -1 for p in pids])
+    masses = numpy.array([top.atoms[p].mass if p in top.atoms else 0.0 for p in pids], dtype=numpy.double)
+    in_top = numpy.where(chain_idx != -1)[0]
+    order = in_top[numpy.argsort(chain_idx[in_top], kind='mergesort')]
+    mol_ids, counts = numpy.unique(chain_idx[order], return_counts=True)
+    offsets = numpy.concatenate(([0], numpy.cumsum(counts)))
+    return order, offsets, mol_ids, masses
+
+
+def particle_masses(h5file, group_name, frame=0):
+    """Returns masses of the sorted particles from H5MD or None if not there."""
+    group = h5file['/particles/{}'.format(group_name)]
+    if 'mass' not in group:
+        return None
+    masses = group['mass']
+    if 'value' in masses:
+        masses = numpy.array(masses['value'][frame])
+        if 'id' in group:
+            ids = numpy.array(group['id/value'][frame])
+            masses = masses[numpy.argsort(numpy.where(ids == -1, numpy.iinfo(ids.dtype).max, ids),
+                                          kind='mergesort')]
+    return numpy.array(masses, dtype=numpy.double)
+
+
+def write_com(h5file, group_name, order, offsets, masses, mol_ids, mass_source,
+              begin=0, end=-1, step=1, block_size=None):
+    """Computes unwrapped molecule COMs and writes them to /particles/<group>_com.
+
+    The trajectory is processed in chunk-aligned blocks of frames, the old COM
+    group is replaced.
+
+    Args:
+        h5file: The h5py.File opened for writing.
+        group_name: The source particle group.
+        order: The columns of the sorted trajectory grouped by molecules.
+        offsets: The CSR offsets of molecules in order.
+        masses: The masses of columns of the sorted trajectory.
+        mol_ids: The molecule ids.
+        mass_source: The description of the mass source stored in provenance.
+        begin, end, step: The frame range.
+        block_size: The number of frames read at once.
+    """
+    group = h5file['/particles/{}'.format(group_name)]
+    position = group['position']
+    if end == -1 or end is None:
+        end = position['value'].shape[0]
+    frames = numpy.arange(begin, end, step)
+    order = numpy.asarray(order)
+    masses = numpy.asarray(masses, dtype=numpy.double)[order]
+    mol_masses = numpy.add.reduceat(masses, offsets[:-1])
+
+    com_name = com_group_name(group_name)
+    if com_name in h5file['/particles']:
+        del h5file['/particles'][com_name]
+    com_group = h5file['/particles'].create_group(com_name)
+    group.copy('box', com_group)
+    com_group.create_dataset('mass', data=mol_masses)
+    com_position = com_group.create_group('position')
+    n_mol = len(offsets) - 1
+    chunk_frames = max(1, min(len(frames), 2**20 // (24*max(n_mol, 1))))
+    value = com_position.create_dataset(
+        'value', shape=(len(frames), n_mol, 3), dtype=numpy.double, chunks=(chunk_frames, max(n_mol, 1), 3))
+    com_position.create_dataset('time', data=position['time'][begin:end:step])
+    if 'step' in position:
+        com_position.create_dataset('step', data=position['step'][begin:end:step])
+    # Molecule ids as the time element, like id of other particle groups; time and step are linked.
+    mol_ids = numpy.asarray(mol_ids)
+    com_id = com_group.create_group('id')
+    id_value = com_id.create_dataset(
+        'value', shape=(len(frames), n_mol), dtype=mol_ids.dtype, chunks=(chunk_frames, max(n_mol, 1)))
+    for k in ('time', 'step'):
+        if k in com_position:
+            com_id[k] = com_position[k]
+
+    trajectory = h5md_trajectory.H5MDTrajectory(h5file, group_name)
+    t0 = 0
+    for _, trj in trajectory.iter_blocks(block_size, begin, end, step):
+        com, _ = bonds.calculate_com_chains_batch(trj[:, order], masses, offsets=offsets)
+        value[t0:t0+len(com)] = com
+        id_value[t0:t0+len(com)] = mol_ids
+        t0 += len(com)
+        sys.stdout.write('Progress: {:.2f} %\r'.format(100.0*t0/len(frames)))
+        sys.stdout.flush()
+    sys.stdout.write('\n')
+
+    com_group.attrs['provenance'] = json.dumps({
+        'source_group': group_name,
+        'source_hash': source_hash(h5file, group_name),
+        'molecules_hash': molecules_hash(order, offsets),
+        'masses_hash': masses_hash(masses),
+        'mass_source': mass_source,
+        'begin': int(begin), 'end': int(end), 'step': int(step)
+    })
+
+
+def has_com(h5file, group_name, check_source=True, **expected):
+    """Checks if the COM group is there and (optionally) was computed from the current trajectory.
+
+    Args:
+        h5file: The h5py.File.
+        group_name: The source particle group.
+        check_source: Compare the hash of the source trajectory.
+        expected: The provenance entries that have to match, e.g. molecules_hash,
+            masses_hash, mass_source, begin, end, step.
+    """
+    com_name = com_group_name(group_name)
+    if com_name not in h5file['/particles']:
+        return False
+    provenance = json.loads(h5file['/particles'][com_name].attrs['provenance'])
+    if check_source and provenance['source_hash'] != source_hash(h5file, group_name):
+        print('Warning!: {} is outdated, source trajectory changed'.format(com_name))
+        return False
+    changed = sorted(k for k, v in expected.items() if provenance.get(k) != v)
+    if changed:
+        print('Warning!: {} is outdated, changed: {}'.format(com_name, ', '.join(changed)))
+        return False
+    return True
+
+
+def read_com(h5file, group_name, begin=0, end=-1, step=1):
+    """Reads molecule COMs from /particles/<group>_com.
+
+    The frame range is given in frames of the COM group.
+
+    Returns:
+        The tuple with (T, molecules, 3) COMs, (T, 3) system COM, molecule masses and time.
+    """
+    com_group = h5file['/particles'][com_group_name(group_name)]
+    if end == -1:
+        end = com_group['position/value'].shape[0]
+    com = numpy.array(com_group['position/value'][begin:end:step])
+    mol_masses = numpy.array(com_group['mass'])
+    sys_com = numpy.einsum('tck,c->tk', com, mol_masses) / mol_masses.sum()
+    return com, sys_com, mol_masses, numpy.array(com_group['position/time'][begin:end:step])
@@ -0,0 +1,197 @@
+"""
+Copyright (C) 2017 Jakub Krajniak <jkrajniak@gmail.com>
+
+This file is part of lab-tools.
+
+lab-tools is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import h5py
+import numpy
+
+from md_libs import files_io
+
+__doc__ = "Lazy reader of H5MD particle trajectories."
+
+# Limits of the chunk cache of a single dataset.
+MIN_CACHE_BYTES = 2**20
+MAX_CACHE_BYTES = 2**30
+
+
+def _next_prime(n):
+    n = max(2, int(n))
+    while any(n % d == 0 for d in range(2, int(n**0.5) + 1)):
+        n += 1
+    return n
+
+
+def chunk_cache(dataset):
+    """Returns (nslots, nbytes) of the chunk cache that holds one row of chunks along time.
+
+    Reading a frame or a block of frames then decompresses every chunk only once.
+    """
+    if not dataset.chunks:
+        return None
+    chunk_bytes = int(numpy.prod(dataset.chunks)) * dataset.dtype.itemsize
+    chunks_per_row = int(numpy.prod([-(-s // c) for s, c in zip(dataset.shape[1:], dataset.chunks[1:])]))
+    nbytes = int(min(max(chunk_bytes * chunks_per_row, MIN_CACHE_BYTES), MAX_CACHE_BYTES))
+    return _next_prime(100 * max(1, nbytes // chunk_bytes)), int(nbytes)
+
+
+class H5MDTrajectory(object):
+    """Trajectory of the particle group of the H5MD file, read on demand.
+
+    The frames are sorted by particle ids, unwrapped with the image dataset,
+    restricted to the selected species/states and converted to dtype, one frame
+    or one block at a time. The selection of particles is taken from the first
+    frame.
+
+    Example:
+        with H5MDTrajectory('traj.h5', 'atoms', species=[1, 2]) as trj:
+            for frames, block in trj.iter_blocks(1000):
+                ...
+    """
+
+    def __init__(self, h5file, group='atoms', sort=True, unwrap=True, species=None, state=None,
+                 dtype=None):
+        """
+        Args:
+            h5file: The file name or the opened h5py.File.
+            group: The particle group.
+            sort: Sort columns by the id dataset (if there).
+            unwrap: Add box*image (if there is image dataset).
+            species: The list of species to select, None for all.
+            state: The list of states to select, None for all.
+            dtype: The dtype of returned positions, None keeps the dtype of the file.
+        """
+        self._own_file = not isinstance(h5file, h5py.File)
+        self.h5file = h5py.File(h5file, 'r') if self._own_file else h5file
+        self.group_name = group
+        self.group = self.h5file['/particles/{}'.format(group)]
+        self.dtype = dtype
+        self.position = self._open('position/value')
+        self.ids = self._open('id/value') if sort and 'id' in self.group else None
+        self.image = self._open('image/value') if unwrap and 'image' in self.group else None
+
+        # Assumes that box is static even if there are time-dependent values.
+        box = self.group['box/edges']
+        self.box = numpy.array(box['value'][0] if 'value' in box else box)
+        self.time = numpy.array(self.group['position/time'])
+
+        self.columns = None
+        if species is not None or state is not None:
+            mask = numpy.ones(self.position.shape[1], dtype=bool)
+            if species is not None:
+                mask &= numpy.in1d(self.read_static('species'), species)
+            if state is not None:
+                mask &= numpy.in1d(self.read_static('state'), state)
+            self.columns = numpy.where(mask)[0]
+
+    def _open(self, path):
+        """Opens the dataset with the chunk cache tuned for its layout."""
+        dataset = self.group[path]
+        cache = chunk_cache(dataset)
+        if cache is None:
+            return dataset
+        # The cache is set only when the dataset is opened for the first time.
+        del dataset
+        try:
+            dapl = h5py.h5p.create(h5py.h5p.DATASET_ACCESS)
+            dapl.set_chunk_cache(cache[0], cache[1], 1.0)
+            return h5py.Dataset(h5py.h5d.open(self.group.id, path.encode(), dapl=dapl))
+        except (AttributeError, TypeError, ValueError):
+            return self.group[path]
+
+    def __len__(self):
+        return self.position.shape[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self._own_file:
+            self.h5file.close()
+
+    @property
+    def num_particles(self):
+        return len(self.columns) if self.columns is not None else self.position.shape[1]
+
+    def _sorted(self, data, start, stop, step, permutation=None):
+        if self.ids is None:
+            return data, permutation
+        if permutation is None:
+            permutation = files_io.sort_permutation(self.ids[start:stop:step])
+        return files_io.sort_h5md_array(data, None, permutation=permutation), permutation
+
+    def read(self, start=0, stop=None, step=1):
+        """Returns (T, N, 3) positions of frames start:stop:step."""
+        if stop is None:
+            stop = len(self)
+        trj, permutation = self._sorted(numpy.array(self.position[start:stop:step]), start, stop, step)
+        if self.image is not None:
+            image, _ = self._sorted(numpy.array(self.image[start:stop:step]), start, stop, step, permutation)
+            trj = trj + self.box*image
+        if self.columns is not None:
+            trj = trj[:, self.columns]
+        if self.dtype is not None:
+            trj = trj.astype(self.dtype, copy=False)
+        return trj
+
+    def read_element(self, name, start=0, stop=None, step=1):
+        """Returns the per-particle element (species, state...) of frames start:stop:step, sorted.
+
+        A time-independent dataset is returned as it is, (N, ...) instead of (T, N, ...).
+        """
+        data = self.group[name]
+        if not isinstance(data, h5py.Group):
+            data = numpy.array(data)
+            return data if self.columns is None else data[self.columns]
+        if stop is None:
+            stop = len(self)
+        data, _ = self._sorted(numpy.array(data['value'][start:stop:step]), start, stop, step)
+        return data if self.columns is None else data[:, self.columns]
+
+    def read_static(self, name, frame=0):
+        """Returns the per-particle dataset (species, state, mass...) of the frame, sorted."""
+        data = self.read_element(name, frame, frame + 1)
+        return data[0] if isinstance(self.group[name], h5py.Group) else data
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step < 1:
+                raise ValueError('Only positive step is supported')
+            return self.read(start, stop, step)
+        key = int(key)
+        if key < 0:
+            key += len(self)
+        if not 0 <= key < len(self):
+            raise IndexError('Frame {} out of range'.format(key))
+        return self.read(key, key + 1)[0]
+
+    def iter_blocks(self, size=None, begin=0, end=-1, step=1):
+        """Yields (frames, (T, N, 3) positions) in blocks that follow HDF5 chunks.
+
+        Args:
+            size: The number of frames in the block, rounded to the chunk size.
+            begin, end, step: The frame range.
+        """
+        for start, stop in files_io.chunk_aligned_blocks(self.position, begin, end, size):
+            first = start + (begin - start) % step
+            if first >= stop:
+                continue
+            yield numpy.arange(first, stop, step), self.read(first, stop, step)
@@ -0,0 +1,141 @@
+"""
+Copyright (C) 2017 Jakub Krajniak <jkrajniak@gmail.com>
+
+This file is part of lab-tools.
+
+lab-tools is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import multiprocessing as mp
+import numpy
+import os
+
+__doc__ = """Frame decomposition of trajectory analysis.
+
+FrameExecutor splits the frame range into chunk-aligned ranges and runs the worker
+function on a local process pool or, when launched with mpirun, on MPI ranks."""
+
+# Variables set by MPI launchers (Open MPI, MPICH/Intel MPI, PMIx, MVAPICH).
+_MPI_ENV = ('OMPI_COMM_WORLD_SIZE', 'PMI_SIZE', 'PMIX_RANK', 'MV2_COMM_WORLD_SIZE')
+
+
+def mpi_comm():
+    """Returns MPI.COMM_WORLD if launched with mpirun on more than one rank, otherwise None."""
+    if not any(v in os.environ for v in _MPI_ENV):
+        return None
+    try:
+        from mpi4py import MPI
+    except ImportError:
+        return None
+    if MPI.COMM_WORLD.size > 1:
+        return MPI.COMM_WORLD
+    return None
+
+
+def split_frames(begin, end, parts, chunk=1):
+    """Splits the frame range into at most parts ranges with boundaries on the chunk grid.
+
+    Args:
+        begin: The first frame.
+        end: The last frame (right open).
+        parts: The number of ranges.
+        chunk: The number of frames in the HDF5 chunk.
+
+    Returns:
+        The list of (start, stop) tuples.
+    """
+    chunk = max(1, int(chunk))
+    first_chunk = begin // chunk
+    num_chunks = (end - 1) // chunk - first_chunk + 1 if end > begin else 0
+    ranges = []
+    for chunks in numpy.array_split(numpy.arange(num_chunks), max(1, min(parts, num_chunks))):
+        if len(chunks) == 0:
+            continue
+        start = max(begin, (first_chunk + chunks[0])*chunk)
+        stop = min(end, (first_chunk + chunks[-1] + 1)*chunk)
+        ranges.append((int(start), int(stop)))
+    return ranges
+
+
+def _run(params):
+    function, start_stop, args = params
+    return function(start_stop[0], start_stop[1], *args)
+
+
+def _reduce(results, reduce_function):
+    if reduce_function is None:
+        return results
+    output = None
+    for r in results:
+        output = r if output is None else reduce_function(output, r)
+    return output
+
+
+class FrameExecutor(object):
+    """Runs function(start, stop, *args) over frame ranges and reduces the results.
+
+    The worker function has to be defined at the module level. The results are
+    combined in the frame order with reduce_function(a, b), without it the list
+    of results is returned. With MPI every rank reduces its own ranges and the
+    partial results are gathered on the root rank, other ranks get None.
+    """
+
+    def __init__(self, processes=None, parts_per_process=4):
+        self.comm = mpi_comm()
+        self.processes = processes or mp.cpu_count()
+        self.parts_per_process = parts_per_process
+
+    @property
+    def backend(self):
+        return 'mpi' if self.comm is not None else 'pool'
+
+    @property
+    def size(self):
+        return self.comm.size if self.comm is not None else self.processes
+
+    @property
+    def is_root(self):
+        return self.comm is None or self.comm.rank == 0
+
+    def map(self, function, begin, end, args=(), chunk=1, reduce_function=None):
+        """Runs function over [begin, end) split in chunk-aligned ranges.
+
+        Args:
+            function: The worker function(start, stop, *args).
+            begin, end: The frame range.
+            args: The extra arguments of the worker function.
+            chunk: The chunk size along the time axis, ranges do not split chunks.
+            reduce_function: The function that combines two results.
+
+        Returns:
+            The reduced result (on the root rank).
+        """
+        ranges = split_frames(begin, end, self.size*self.parts_per_process, chunk)
+        if self.comm is not None:
+            rank_ranges = numpy.array_split(numpy.arange(len(ranges)), self.comm.size)[self.comm.rank]
+            results = [function(ranges[i][0], ranges[i][1], *args) for i in rank_ranges]
+            if reduce_function is not None:
+                results = [_reduce(results, reduce_function)] if results else []
+            results = self.comm.gather(results, root=0)
+            if self.comm.rank != 0:
+                return None
+            return _reduce([r for rank_results in results for r in rank_results], reduce_function)
+        if self.processes == 1 or len(ranges) <= 1:
+            results = [_run((function, r, args)) for r in ranges]
+        else:
+            pool = mp.Pool(processes=self.processes)
+            results = pool.map(_run, [(function, r, args) for r in ranges], chunksize=1)
+            pool.close()
+            pool.join()
+        return _reduce(results, reduce_function)
@@ -0,0 +1,112 @@
+"""
+Copyright (C) 2017 Jakub Krajniak <jkrajniak@gmail.com>
+
+This file is part of lab-tools.
+
+lab-tools is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import numpy
+
+__doc__ = """Spatial regions for the selection of atoms and bonded tuples.
+
+Every region returns a boolean mask over atoms for a frame (N, 3) or a block
+of frames (T, N, 3), tuple_mask() reduces it to the tuples with all atoms
+inside. The mask is passed as the valid argument of the bonds.*_array kernels."""
+
+_AXIS = {'x': 0, 'y': 1, 'z': 2}
+
+
+class Box(object):
+    """Axis-aligned box, lower <= r <= upper."""
+
+    def __init__(self, lower, upper):
+        self.lower = numpy.asarray(lower, dtype=numpy.double)
+        self.upper = numpy.asarray(upper, dtype=numpy.double)
+
+    def mask(self, positions, box=None):
+        positions = numpy.asarray(positions)
+        return numpy.all((positions >= self.lower) & (positions <= self.upper), axis=-1)
+
+    def __repr__(self):
+        return 'Box({}, {})'.format(tuple(self.lower), tuple(self.upper))
+
+
+class Slab(object):
+    """Slab lower <= r[axis] <= upper."""
+
+    def __init__(self, axis, lower, upper):
+        self.axis = _AXIS[axis] if axis in _AXIS else int(axis)
+        self.lower = float(lower)
+        self.upper = float(upper)
+
+    def mask(self, positions, box=None):
+        coordinate = numpy.asarray(positions)[..., self.axis]
+        return (coordinate >= self.lower) & (coordinate <= self.upper)
+
+    def __repr__(self):
+        return 'Slab({}, {}, {})'.format('xyz'[self.axis], self.lower, self.upper)
+
+
+class Sphere(object):
+    """Sphere |r - center| <= radius, with minimum image if the box is given."""
+
+    def __init__(self, center, radius):
+        self.center = numpy.asarray(center, dtype=numpy.double)
+        self.radius = float(radius)
+
+    def mask(self, positions, box=None):
+        d = numpy.asarray(positions) - self.center
+        if box is not None:
+            box = numpy.asarray(box)
+            d -= box*numpy.floor(d/box + 0.5)
+        return numpy.einsum('...k,...k->...', d, d) <= self.radius**2
+
+    def __repr__(self):
+        return 'Sphere({}, {})'.format(tuple(self.center), self.radius)
+
+
+def parse_region(spec, scale=1.0):
+    """Creates the region from the text definition.
+
+    Formats: box:x0,y0,z0:x1,y1,z1, slab:axis:lower:upper or sphere:x,y,z:radius,
+    optionally preceded by the name, e.g. bulk=slab:z:2.0:8.0. Lengths are
+    multiplied by scale.
+
+    Returns:
+        The tuple with name (or None) and the region.
+    """
+    name = None
+    if '=' in spec:
+        name, spec = spec.split('=', 1)
+    fields = spec.split(':')
+    kind = fields[0]
+    try:
+        if kind == 'box':
+            region = Box([float(x)*scale for x in fields[1].split(',')],
+                         [float(x)*scale for x in fields[2].split(',')])
+        elif kind == 'slab':
+            region = Slab(fields[1], float(fields[2])*scale, float(fields[3])*scale)
+        elif kind == 'sphere':
+            region = Sphere([float(x)*scale for x in fields[1].split(',')], float(fields[2])*scale)
+        else:
+            raise ValueError('unknown region type {}'.format(kind))
+    except (IndexError, KeyError, ValueError) as ex:
+        raise ValueError('Wrong region definition {}: {}'.format(spec, ex))
+    return name, region
+
+
+def tuple_mask(atom_mask, tuples):
+    """Reduces the (..., N) atom mask to the (..., M) mask of tuples with all atoms inside."""
+    return atom_mask[..., numpy.asarray(tuples)].all(axis=-1)
@@ -0,0 +1,88 @@
+"""
+Copyright (C) 2017 Jakub Krajniak <jkrajniak@gmail.com>
+
+This file is part of lab-tools.
+
+lab-tools is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import numpy
+import os
+import tempfile
+
+__doc__ = "Numpy arrays shared with multiprocessing workers without pickling."
+
+# Memory-mapped file in tmpfs is kept in RAM, only one copy for all processes.
+SHARED_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+# Arrays already attached in this process, key: file name.
+_attached = {}
+
+
+class SharedArray(object):
+    """Copy of numpy array in a temporary memory-mapped file.
+
+    Workers get the small picklable handle and attach a zero-copy view with
+    attach(). The file is removed with close() (or at the end of with block).
+    """
+
+    def __init__(self, array, dir_name=None):
+        array = numpy.asarray(array)
+        fd, self.file_name = tempfile.mkstemp(
+            prefix='md_libs_', suffix='.dat', dir=dir_name or SHARED_DIR)
+        os.close(fd)
+        self.shape = array.shape
+        self.dtype = array.dtype
+        if array.size > 0:
+            data = numpy.memmap(self.file_name, dtype=self.dtype, mode='w+', shape=self.shape)
+            data[:] = array
+            data.flush()
+            del data
+
+    @property
+    def handle(self):
+        """The picklable handle (file name, dtype, shape) passed to workers."""
+        return self.file_name, self.dtype.str, self.shape
+
+    @property
+    def array(self):
+        """Read-only view of the shared data."""
+        return attach(self.handle)
+
+    def close(self):
+        _attached.pop(self.file_name, None)
+        if os.path.exists(self.file_name):
+            os.remove(self.file_name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def share(array, dir_name=None):
+    """Returns SharedArray with the copy of array."""
+    return SharedArray(array, dir_name)
+
+
+def attach(handle):
+    """Returns read-only zero-copy view of the shared array, mapped once per process."""
+    file_name, dtype, shape = handle
+    if file_name not in _attached:
+        if numpy.prod(shape) == 0:
+            _attached[file_name] = numpy.zeros(shape, dtype=dtype)
+        else:
+            _attached[file_name] = numpy.memmap(file_name, dtype=dtype, mode='r', shape=tuple(shape))
+    return _attached[file_name]
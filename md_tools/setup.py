@@ -37,6 +37,8 @@ ext_module = Extension(
 ext_module_rdf = Extension(
     'md_libs._rdf',
     ['md_libs/_rdf.pyx'],
+    extra_compile_args=['-fopenmp'],
+    extra_link_args=['-fopenmp'],
 )
 
 setup(